@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# Benchmark suite for the dice-virsh provider utilities.
+#
+# Runs every benchmark against the stand-in virsh in benchmarks/fakevirsh,
+# so no libvirtd is needed, and writes the timings as JSON. Pass a previous
+# result file with --compare to report (and fail on) regressions.
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+UTILS_DIR = os.path.join(os.path.dirname(HERE), 'utils')
+
+FAKE_VIRSH_DIR = os.path.join(HERE, 'fakevirsh')
+
+sys.path.insert(0, UTILS_DIR)
+from siblings import load_sibling
+
+MODULES = ['instrument', 'hostfacts', 'fixtures', 'virsh', 'session',
+           'journal', 'scheduler', 'buildscript', 'item', 'utils_xml_gen']
+
+ARG_FUNCTIONS = [
+    'string_domname', 'string_domname_running', 'string_domname_paused',
+    'string_domname_shutoff', 'string_domname_rop', 'string_poolname',
+    'string_poolname_ina', 'string_poolname_act', 'string_netname',
+    'string_netname_ina', 'string_netname_act', 'string_volname',
+    'cpu_list', 'cpu_count', 'memory',
+]
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    # A benchmark yields (name, callable) pairs; every callable is timed
+    # once per iteration after an untimed warm-up call.
+    def _register(function):
+        BENCHMARKS.append((name, function))
+        return function
+    return _register
+
+
+class Env(object):
+    def __init__(self, args, work_dir):
+        self.args = args
+        self.work_dir = work_dir
+        self.state_path = os.path.join(work_dir, 'fakevirsh-state.json')
+        self.catalog_path = None
+        self.modules = {}
+
+    def setup(self):
+        os.environ['PATH'] = FAKE_VIRSH_DIR + os.pathsep + os.environ['PATH']
+        os.environ['FAKE_VIRSH_LATENCY'] = str(self.args.latency)
+        os.environ['FAKE_VIRSH_DOMAINS'] = str(self.args.domains)
+        os.environ['FAKE_VIRSH_POOLS'] = str(self.args.pools)
+        os.environ['FAKE_VIRSH_NETS'] = str(self.args.nets)
+        os.environ['FAKE_VIRSH_VOLS'] = str(self.args.vols)
+        os.environ['FAKE_VIRSH_STATE'] = self.state_path
+        os.environ['DICE_VIRSH_JOURNAL'] = os.path.join(self.work_dir,
+                                                        'runlog.jsonl')
+        os.mkdir(os.path.join(self.work_dir, 'oracles'))
+        os.chdir(self.work_dir)
+
+        from dice.utils import data_dir
+        data_dir.USER_BASE_DIR = self.work_dir
+        self.catalog_path = os.path.join(self.work_dir, 'virsh')
+        for name in MODULES:
+            self.modules[name] = load_sibling(name)
+
+    def teardown(self):
+        # Buffered journal records must reach the file before work_dir goes.
+        if 'journal' in self.modules:
+            self.modules['journal'].close()
+
+    def reset_state(self):
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        self.modules['virsh'].invalidate_inventory()
+
+    def reset_catalog(self):
+        if os.path.exists(self.catalog_path):
+            os.remove(self.catalog_path)
+        self.modules['virsh']._CATALOGS.clear()
+
+
+@benchmark('catalog')
+def bench_catalog(env):
+    virsh = env.modules['virsh']
+
+    def _cold():
+        env.reset_catalog()
+        virsh.load_cmds_from_help(env.catalog_path)
+
+    def _serial():
+        env.reset_catalog()
+        virsh.load_cmds_from_help(env.catalog_path, workers=1)
+
+    def _warm():
+        virsh.load_commands()
+
+    yield 'load_cmds_from_help', _cold
+    yield 'load_cmds_from_help.serial', _serial
+    yield 'load_commands.warm', _warm
+
+
+@benchmark('args')
+def bench_args(env):
+    virsh = env.modules['virsh']
+    for name in ARG_FUNCTIONS:
+        function = getattr(virsh, name)
+
+        def _cold(function=function):
+            env.reset_state()
+            function()
+
+        yield name, _cold
+
+    yield 'string_domname.cached', virsh.string_domname
+
+
+@benchmark('buildscript')
+def bench_buildscript(env):
+    virsh = env.modules['virsh']
+    buildscript = env.modules['buildscript']
+    commands = sorted(virsh.commands())
+    args_yaml = os.path.join(buildscript.dir_prove(), 'args.yaml')
+
+    def _arg_build():
+        buildscript._EMITTERS.clear()
+        if os.path.exists(args_yaml):
+            os.remove(args_yaml)
+        for command in commands:
+            buildscript.arg_build(command, sorted(virsh.options(command)))
+
+    def _arg_build_repeat():
+        for command in commands:
+            buildscript.arg_build(command, sorted(virsh.options(command)))
+
+    yield 'arg_build', _arg_build
+    yield 'arg_build.repeat', _arg_build_repeat
+
+
+@benchmark('item')
+def bench_item(env):
+    item = env.modules['item']
+
+    class BenchItem(item.Item):
+        def __init__(self, data):
+            self.data = data
+
+        def get(self, key):
+            return self.data.get(key)
+
+    items = [
+        BenchItem({'subcmd': 'dominfo', 'options': ['domain'],
+                   'domain_arg': 'dom0'}),
+        BenchItem({'subcmd': 'list', 'options': ['all']}),
+        BenchItem({'subcmd': 'vol-list', 'options': ['pool'],
+                   'pool_arg': 'pool0'}),
+    ]
+    for bench_item in items:
+        yield 'run.%s' % bench_item.get('subcmd'), bench_item.run
+
+
+@benchmark('session')
+def bench_session(env):
+    session = env.modules['session']
+    pool = session.SessionPool(1)
+
+    def _run(cmdline):
+        def _inner():
+            result = pool.run(cmdline)
+            if not result.completed:
+                raise RuntimeError('virsh session failed on %r: %s' %
+                                   (cmdline, result.stderr))
+        return _inner
+
+    try:
+        yield 'run.list', _run('virsh list --all')
+        yield 'run.vol-list', _run('virsh vol-list --pool pool0')
+    finally:
+        pool.close()
+
+
+@benchmark('utils_xml_gen')
+def bench_xml_gen(env):
+    if not os.path.isfile(env.args.rng):
+        sys.stderr.write('Skipping utils_xml_gen: %s not found\n' %
+                         env.args.rng)
+        return
+    xml_gen = env.modules['utils_xml_gen']
+    schema = xml_gen.load_schema(env.args.rng)
+    seeds = iter(range(1 << 30))
+
+    def _generate():
+        xml_gen.generate_domain(schema, seed=next(seeds))
+
+    yield 'generate_domain', _generate
+
+
+def run_benchmarks(env, only=None):
+    instrument = env.modules['instrument']
+    results = {}
+    for group, function in BENCHMARKS:
+        if only and group not in only:
+            continue
+        env.reset_state()
+        for name, bench in function(env):
+            name = '%s.%s' % (group, name)
+            stats = instrument.StageStats(name)
+            best = None
+            bench()
+            for _ in range(env.args.iterations):
+                start = time.time()
+                bench()
+                elapsed = time.time() - start
+                stats.add(elapsed, False)
+                best = elapsed if best is None else min(best, elapsed)
+            results[name] = stats.summary()
+            results[name]['min'] = best
+            del results[name]['forks']
+            sys.stderr.write('%-48s %9.2f ms\n' %
+                             (name, results[name]['mean'] * 1000))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    lines = ['%-48s %11s %11s %7s' % ('benchmark', 'base(ms)', 'now(ms)',
+                                      'ratio')]
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        before = baseline[name]['mean']
+        after = results[name]['mean']
+        ratio = after / before if before else 0.0
+        flag = ''
+        if ratio > tolerance:
+            regressions.append(name)
+            flag = ' !'
+        lines.append('%-48s %11.2f %11.2f %7.2f%s' % (
+            name, before * 1000, after * 1000, ratio, flag))
+    sys.stdout.write('\n'.join(lines) + '\n')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark dice-virsh against a stand-in virsh.')
+    parser.add_argument('-o', '--output', default='benchmark.json')
+    parser.add_argument('-n', '--iterations', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds every fake virsh command sleeps')
+    parser.add_argument('--domains', type=int, default=6)
+    parser.add_argument('--pools', type=int, default=2)
+    parser.add_argument('--nets', type=int, default=2)
+    parser.add_argument('--vols', type=int, default=3)
+    parser.add_argument('--rng',
+                        default='/usr/share/libvirt/schemas/domain.rng')
+    parser.add_argument('--only', action='append',
+                        choices=[name for name, _ in BENCHMARKS])
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='previous output to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='slowdown ratio reported as a regression')
+    args = parser.parse_args(argv)
+
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as fp:
+            baseline = json.load(fp)['results']
+
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='dice-virsh-bench-')
+    env = Env(args, work_dir)
+    try:
+        env.setup()
+        results = run_benchmarks(env, args.only)
+    finally:
+        env.teardown()
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+
+    report = {
+        'meta': {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'iterations': args.iterations,
+            'latency': args.latency,
+            'inventory': {'domains': args.domains, 'pools': args.pools,
+                          'nets': args.nets, 'vols': args.vols},
+        },
+        'results': results,
+    }
+    with open(output, 'w') as fp:
+        json.dump(report, fp, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            sys.stderr.write('%d regression(s) over %.2fx\n' %
+                             (len(regressions), args.tolerance))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,13 @@
+import logging
 import sys
 import os
 import re
+import threading
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 DICE_SIGNATURE = 'JunLi'
 
@@ -13,121 +20,245 @@ def dir_prove():
     return wd
 
 
+ORACLE_HEAD = """- name: %(name)s
+  depends_on: %(name)s
+%(require)s  oracle: |
+"""
+
+ORACLE_CHECK = """      if %(name)s is %(kind)s:
+          if %(cond)s:
+              return SUCCESS()
+          else:
+              return FAIL()
+"""
+
+TEMPLATES = {}
+
+FAMILIES = {}
+
+XMLARG_FAMILIES = {
+    'cpu_count': 'cpu_count',
+    'cpu_list': 'cpu_list',
+    'memory': 'memory',
+}
+
+_FAMILY_CACHE = {}
+
+
+def register_template(family, body, prefix=None):
+    # ``body`` is formatted with name, argtype and dependency and ends
+    # without a separator line; the generators add one where needed. A
+    # family with a ``prefix`` is picked for every argtype starting with
+    # it; the longest matching prefix wins.
+    TEMPLATES[family] = ORACLE_HEAD + body
+    if prefix is not None:
+        FAMILIES[prefix] = family
+    _FAMILY_CACHE.clear()
+
+
+def register_check(family, kind, cond, prefix=None):
+    register_template(family, ORACLE_CHECK % {
+        'name': '%(name)s', 'kind': kind, 'cond': cond}, prefix=prefix)
+
+
+register_template('bool', '      return SUCCESS()\n', prefix='bool')
+register_check('number', 'Integer', '%(name)s in virsh.%(argtype)s()',
+               prefix='number')
+register_check('string_xml', 'Xml', '%(name)s base virsh.%(argtype)s_base()',
+               prefix='string_xml')
+register_check('string', 'String', '%(name)s in virsh.%(argtype)s()',
+               prefix='string')
+register_check('list', 'StringList', 'all(%(name)s in virsh.%(argtype)s())',
+               prefix='list')
+register_check('volname_pool', 'String',
+               '%(name)s in virsh.%(argtype)s(%(dependency)s)')
+register_check('cpu_count', 'Integer', '%(name)s in virsh.cpu_count()')
+register_check('cpu_list', 'StringList', '%(name)s in virsh.cpu_list()')
+register_check('memory', 'Integer', '%(name)s in virsh.memory()')
+
+
+def family(argtype):
+    if argtype not in _FAMILY_CACHE:
+        matches = [prefix for prefix in FAMILIES if argtype.startswith(prefix)]
+        _FAMILY_CACHE[argtype] = (
+            FAMILIES[max(matches, key=len)] if matches else None)
+    return _FAMILY_CACHE[argtype]
+
+
+def render(family_name, name, argtype=None, dependency=None):
+    require = ''
+    if dependency is not None:
+        require = '  require: %s is SUCCESS\n' % dependency
+    return TEMPLATES[family_name] % {
+        'name': name,
+        'argtype': argtype,
+        'dependency': dependency,
+        'require': require,
+    }
+
+
+def arg_name(opt):
+    return (str(opt) + '_arg').replace('-', '_')
+
+
+_VIRSH_MOD = None
+
+
+def virsh_module():
+    global _VIRSH_MOD
+    if _VIRSH_MOD is None:
+        _VIRSH_MOD = sys.modules['dice-virsh_utils.virsh']
+    return _VIRSH_MOD
+
+
 def arg_generate(fp, sub, options):
-    opts = options[:]
-    virsh_mod = sys.modules['dice-virsh_utils.virsh']
-    temp = None
+    argtype = virsh_module().argtype
+    opts = []
+    volopt = None
+    for opt in options:
+        otype = argtype(sub, opt)
+        if volopt is None and otype.startswith('string_volname'):
+            volopt = (opt, otype)
+        else:
+            opts.append((opt, otype))
+
     poolarg = None
-    for opt in opts:
-        if re.match('string_volname', virsh_mod.argtype(sub, opt)):
-            temp = opt
-            opts.remove(opt)
-            break
-    for opt in opts:
-        argtype = virsh_mod.argtype(sub, opt)
-        opt = str(opt) + '_arg'
-        opt = opt.replace('-', '_')
-
-        fp.write('- name: ' + opt + '\n')
-        fp.write('  depends_on: ' + opt + '\n')
-        fp.write('  oracle: |' + '\n')
-
-        if re.match('bool', argtype):
-            fp.write('      return SUCCESS()' + '\n')
-        elif re.match('number', argtype):
-            fp.write('      if ' + opt + ' is Integer:' + '\n')
-            fp.write('          if ' + opt + ' in virsh.' + argtype + '():' +
-                     '\n')
-            fp.write('              return SUCCESS()' + '\n')
-            fp.write('          else:' + '\n')
-            fp.write('              return FAIL()' + '\n')
-        elif re.match('string_xml', argtype):
-            fp.write('      if ' + opt + ' is Xml:' + '\n')
-            fp.write('          if ' + opt + ' base virsh.' + argtype +
-                     '_base():' + '\n')
-            fp.write('              return SUCCESS()' + '\n')
-            fp.write('          else:' + '\n')
-            fp.write('              return FAIL()' + '\n')
-        elif re.match('string', argtype):
-            if re.search('poolname', argtype) and temp:
-                poolarg = opt
-            fp.write('      if ' + opt + ' is String:' + '\n')
-            fp.write('          if ' + opt + ' in virsh.' + argtype + '():' +
-                     '\n')
-            fp.write('              return SUCCESS()' + '\n')
-            fp.write('          else:' + '\n')
-            fp.write('              return FAIL()' + '\n')
-        elif re.match('list', argtype):
-            fp.write('      if ' + opt + ' is StringList:' + '\n')
-            fp.write('          if all(' + opt + ' in virsh.' + argtype +
-                     '()):' + '\n')
-            fp.write('              return SUCCESS()' + '\n')
-            fp.write('          else:' + '\n')
-            fp.write('              return FAIL()' + '\n')
-        fp.write('\n')
-    if temp:
-        argtype = virsh_mod.argtype(sub, temp)
-        temp = str(temp) + '_arg'
-        temp = temp.replace('-', '_')
-
-        fp.write('- name: ' + temp + '\n')
-        fp.write('  depends_on: ' + temp + '\n')
-        if poolarg is not None:
-            fp.write('  require: ' + poolarg + ' is SUCCESS\n')
-        fp.write('  oracle: |' + '\n')
-
-        fp.write('      if ' + temp + ' is String:' + '\n')
+    blocks = []
+    for opt, otype in opts:
+        name = arg_name(opt)
+        family_name = family(otype)
+        if family_name is None:
+            logging.warning('No oracle template for %s of %s', otype, sub)
+            continue
+        if family_name == 'string' and 'poolname' in otype and volopt:
+            poolarg = name
+        blocks.append(render(family_name, name, argtype=otype) + '\n')
+
+    # The volume block comes last and is written without a separator.
+    if volopt:
+        opt, otype = volopt
         if poolarg is None:
-            fp.write('          if ' + temp + ' in virsh.' + argtype + '():' +
-                     '\n')
+            blocks.append(render('string', arg_name(opt), argtype=otype))
         else:
-            fp.write('          if ' + temp + ' in virsh.' + argtype + '(' +
-                     poolarg + '):' + '\n')
-        fp.write('              return SUCCESS()' + '\n')
-        fp.write('          else:' + '\n')
-        fp.write('              return FAIL()' + '\n')
+            blocks.append(render('volname_pool', arg_name(opt),
+                                 argtype=otype, dependency=poolarg))
+    fp.write(''.join(blocks))
+
+
+def xmlarg_generate(fp=None, xmlreq=[]):
+    blocks = []
+    for name, xmltype in xmlreq:
+        if xmltype not in XMLARG_FAMILIES:
+            logging.warning('No oracle template for XML argument %s', name)
+            continue
+        blocks.append(render(XMLARG_FAMILIES[xmltype], name) + '\n')
+    fp.write(''.join(blocks))
+
+
+class OracleEmitter(object):
+    # Appends oracle blocks to a YAML file, skipping blocks that the file
+    # already holds. A block's text is fixed by its name, argtype and
+    # dependency, so the text itself is the index key.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.emitted = set()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    def _sync(self):
+        stamp = self._stat()
+        if stamp == self.stamp:
+            return
+        self.emitted = set()
+        if stamp is not None:
+            with open(self.path, 'r') as fp:
+                self.emitted.update(split_blocks(fp.read()))
+        self.stamp = stamp
+
+    def emit(self, text):
+        with self.lock:
+            self._sync()
+            blocks = []
+            for block in split_blocks(text):
+                if block not in self.emitted:
+                    self.emitted.add(block)
+                    blocks.append(block)
+            if not blocks:
+                return 0
+            data = ''.join(block + '\n' for block in blocks)
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0o644)
+            try:
+                os.write(fd, data.encode('utf-8'))
+            finally:
+                os.close(fd)
+            self.stamp = self._stat()
+            return len(blocks)
+
+    def compact(self):
+        with self.lock:
+            self.stamp = None
+            self._sync()
+            if self.stamp is None:
+                return 0
+            with open(self.path, 'r') as fp:
+                blocks = split_blocks(fp.read())
+            unique = []
+            seen = set()
+            for block in blocks:
+                if block not in seen:
+                    seen.add(block)
+                    unique.append(block)
+            tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp_path, 'w') as fp:
+                fp.write(''.join(block + '\n' for block in unique))
+            os.rename(tmp_path, self.path)
+            self.stamp = self._stat()
+            return len(blocks) - len(unique)
+
+
+_EMITTERS = {}
+
+
+def split_blocks(text):
+    return [block.strip('\n') + '\n'
+            for block in re.split(r'(?m)^(?=- name: )', text)
+            if block.strip()]
+
+
+def emitter(name):
+    path = os.path.join(dir_prove(), name)
+    if path not in _EMITTERS:
+        _EMITTERS.setdefault(path, OracleEmitter(path))
+    return _EMITTERS[path]
+
+
+def compact(name='args.yaml'):
+    return emitter(name).compact()
 
 
 def arg_build(sub, opts):
     if opts is None or opts == []:
         return
-    wd = os.path.join(dir_prove(), 'args.yaml')
-    with open(wd, 'a') as fp:
-        arg_generate(fp, sub, opts)
-
-
-def xmlarg_generate(fp=None, xmlreq=[]):
-    for nd in xmlreq:
-        fp.write('- name: ' + nd[0] + '\n')
-        fp.write('  depends_on: ' + nd[0] + '\n')
-        fp.write('  oracle: |' + '\n')
-        if nd[1] in CPU_COUNT:
-            fp.write('      if ' + nd[0] + ' is Integer:' + '\n')
-            fp.write('          if ' + nd[0] + ' in virsh.cpu_count():' +
-                     '\n')
-            fp.write('              return SUCCESS()' + '\n')
-            fp.write('          else:' + '\n')
-            fp.write('              return FAIL()' + '\n')
-        elif nd[1] in CPU_LIST:
-            fp.write('      if ' + nd[0] + ' is StringList:' + '\n')
-            fp.write('          if ' + nd[0] + ' in virsh.cpu_list():' +
-                     '\n')
-            fp.write('              return SUCCESS()' + '\n')
-            fp.write('          else:' + '\n')
-            fp.write('              return FAIL()' + '\n')
-        elif nd[1] in MEMORY:
-            fp.write('      if ' + nd[0] + ' is Integer:' + '\n')
-            fp.write('          if ' + nd[0] + ' in virsh.memory():' +
-                     '\n')
-            fp.write('              return SUCCESS()' + '\n')
-            fp.write('          else:' + '\n')
-            fp.write('              return FAIL()' + '\n')
-        fp.write('\n')
+    fp = StringIO()
+    arg_generate(fp, sub, opts)
+    emitter('args.yaml').emit(fp.getvalue())
 
 
 def xml_complete(xmlfile):
     xmlstr = open(xmlfile, 'r').read()
     xmlreq = re.findall('"(' + DICE_SIGNATURE + '.+?_(.+?))"', xmlstr)
-    wd = os.path.join(dir_prove(), 'xmlargs.yaml')
-    with open(wd, 'a') as fp:
-        xmlarg_generate(fp, xmlreq)
+    fp = StringIO()
+    xmlarg_generate(fp, xmlreq)
+    emitter('xmlargs.yaml').emit(fp.getvalue())
+
+
+if 'dice-virsh_utils.instrument' in sys.modules:
+    sys.modules['dice-virsh_utils.instrument'].install(sys.modules[__name__])
@@ -0,0 +1,290 @@
+import atexit
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import uuid
+
+FIXTURE_SIZE = int(os.environ.get('DICE_VIRSH_FIXTURES', 0))
+
+FIXTURE_INTERVAL = float(os.environ.get('DICE_VIRSH_FIXTURE_INTERVAL', 5))
+
+FIXTURE_DIR = os.environ.get(
+    'DICE_VIRSH_FIXTURE_DIR',
+    os.path.join(tempfile.gettempdir(), 'dice-virsh-fixtures'))
+
+FIXTURE_PREFIX = 'dice-fixture-'
+
+FIXTURE_TARGETS = [
+    ('dom', 'running'),
+    ('dom', 'paused'),
+    ('dom', 'shutoff'),
+    ('pool', 'act'),
+    ('pool', 'ina'),
+    ('net', 'act'),
+    ('net', 'ina'),
+]
+
+DEFINE_COMMANDS = {
+    'dom': 'define',
+    'pool': 'pool-define',
+    'net': 'net-define',
+}
+
+REMOVE_COMMANDS = {
+    'dom': ['destroy', 'undefine'],
+    'pool': ['pool-destroy', 'pool-undefine'],
+    'net': ['net-destroy', 'net-undefine'],
+}
+
+DOMAIN_XML = """<domain type='%(type)s'>
+  <name>%(name)s</name>
+  <memory unit='KiB'>65536</memory>
+  <vcpu>1</vcpu>
+  <os>
+    <type arch='%(arch)s'>hvm</type>
+  </os>
+  <devices/>
+</domain>
+"""
+
+POOL_XML = """<pool type='dir'>
+  <name>%(name)s</name>
+  <target>
+    <path>%(path)s</path>
+  </target>
+</pool>
+"""
+
+NET_XML = """<network>
+  <name>%(name)s</name>
+</network>
+"""
+
+
+def _virsh():
+    return sys.modules['dice-virsh_utils.virsh']
+
+
+def _run(argv):
+    proc = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    _, err = proc.communicate()
+    if proc.returncode != 0:
+        logging.debug('%s failed: %s', ' '.join(argv), err.strip())
+    return proc.returncode == 0
+
+
+def wanted_states(kind, wanted):
+    virsh_mod = _virsh()
+    if kind == 'dom':
+        return virsh_mod.DOMAIN_STATES[wanted]
+    return virsh_mod.OBJECT_STATES[wanted]
+
+
+class FixtureManager(object):
+    # Keeps ``size`` objects in every FIXTURE_TARGETS state. Missing ones
+    # come from surplus fixtures in another state when possible and are
+    # otherwise defined from generated XML, in a background thread. Only
+    # fixtures defined by this manager are reused or removed; other DICE
+    # processes on the host keep theirs.
+    def __init__(self, size, interval, xml_dir):
+        self.size = size
+        self.interval = interval
+        self.xml_dir = xml_dir
+        self.defined = {}
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._cleanup_registered = False
+
+    def _xml(self, kind, name):
+        if not os.path.isdir(self.xml_dir):
+            os.makedirs(self.xml_dir)
+        values = {'name': name}
+        if kind == 'dom':
+            template = DOMAIN_XML
+            values['type'] = 'kvm' if os.path.exists('/dev/kvm') else 'qemu'
+            values['arch'] = platform.machine()
+        elif kind == 'pool':
+            template = POOL_XML
+            values['path'] = os.path.join(self.xml_dir, name)
+            if not os.path.isdir(values['path']):
+                os.makedirs(values['path'])
+        else:
+            template = NET_XML
+
+        path = os.path.join(self.xml_dir, name + '.xml')
+        with open(path, 'w') as fp:
+            fp.write(template % values)
+        return path
+
+    def define(self, kind):
+        name = '%s%s-%s' % (FIXTURE_PREFIX, kind, uuid.uuid4().hex[:8])
+        path = self._xml(kind, name)
+        with self._lock:
+            if not _run(['virsh', DEFINE_COMMANDS[kind], path]):
+                logging.warning('Failed to define %s fixture from %s', kind,
+                                path)
+                return None
+            self.defined[name] = kind
+            self.register_cleanup()
+        return name
+
+    def transition(self, kind, wanted, name, state):
+        transitions = _virsh().RECONCILE_TRANSITIONS[(kind, wanted)]
+        for states, command in transitions:
+            if state in states:
+                return _run(['virsh'] + command + [name])
+        return False
+
+    def _donor(self, kind, wanted, objects):
+        counts = {}
+        for state in objects.values():
+            counts[state] = counts.get(state, 0) + 1
+        transitions = _virsh().RECONCILE_TRANSITIONS[(kind, wanted)]
+        for name, state in sorted(objects.items()):
+            if name not in self.defined:
+                continue
+            if counts[state] <= self.size:
+                continue
+            if any(state in states for states, _ in transitions):
+                return name
+        return None
+
+    def _prepare(self, kind, wanted, objects):
+        target = wanted_states(kind, wanted)[0]
+        name = self._donor(kind, wanted, objects)
+        if name is None:
+            name = self.define(kind)
+            if name is None:
+                return False
+            objects[name] = 'shut off' if kind == 'dom' else 'inactive'
+        if objects[name] != target:
+            if not self.transition(kind, wanted, name, objects[name]):
+                return False
+            objects[name] = target
+        return True
+
+    def replenish(self):
+        virsh_mod = _virsh()
+        snapshot = virsh_mod.INVENTORY.snapshot()
+        prepared = 0
+        with self._lock:
+            for kind in ('dom', 'pool', 'net'):
+                keep = virsh_mod.RECONCILE_KEEP.get(kind, frozenset())
+                objects = dict((name, state) for name, state in snapshot[kind]
+                               if name not in keep)
+                for target_kind, wanted in FIXTURE_TARGETS:
+                    if target_kind != kind:
+                        continue
+                    states = wanted_states(kind, wanted)
+                    ready = [name for name, state in objects.items()
+                             if state in states]
+                    for _ in range(self.size - len(ready)):
+                        if not self._prepare(kind, wanted, objects):
+                            break
+                        prepared += 1
+        if prepared:
+            virsh_mod.invalidate_inventory()
+        return prepared
+
+    def take(self, kind, wanted):
+        # Never blocks on virsh state changes: returns what is ready now and
+        # asks the background thread to top the pool up.
+        names = _virsh().RECONCILER.listing(kind, wanted)
+        if len(names) <= self.size:
+            self.poke()
+        return names
+
+    def poke(self):
+        self._wake.set()
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            if 'dice-virsh_utils.virsh' in sys.modules:
+                try:
+                    self.replenish()
+                except Exception:
+                    logging.exception('Failed to replenish virsh fixtures')
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def start(self):
+        if self._thread is not None or self.size <= 0:
+            return
+        self._thread = threading.Thread(target=self._loop,
+                                        name='dice-virsh-fixtures')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+
+    def register_cleanup(self):
+        with self._lock:
+            if not self._cleanup_registered:
+                atexit.register(self.cleanup)
+                self._cleanup_registered = True
+
+    def cleanup(self):
+        # Runs at exit: the loop must not define new fixtures while the
+        # existing ones are being removed.
+        self.stop()
+        with self._lock:
+            for name, kind in sorted(self.defined.items()):
+                for command in REMOVE_COMMANDS[kind]:
+                    _run(['virsh', command, name])
+                xml_path = os.path.join(self.xml_dir, name + '.xml')
+                if os.path.exists(xml_path):
+                    os.remove(xml_path)
+                if kind == 'pool':
+                    shutil.rmtree(os.path.join(self.xml_dir, name),
+                                  ignore_errors=True)
+            self.defined = {}
+        if 'dice-virsh_utils.virsh' in sys.modules:
+            _virsh().invalidate_inventory()
+
+
+_MANAGER = None
+_MANAGER_LOCK = threading.Lock()
+
+
+def enabled():
+    return FIXTURE_SIZE > 0
+
+
+def manager():
+    global _MANAGER
+    if _MANAGER is None:
+        with _MANAGER_LOCK:
+            if _MANAGER is None:
+                _MANAGER = FixtureManager(FIXTURE_SIZE, FIXTURE_INTERVAL,
+                                          FIXTURE_DIR)
+                if enabled():
+                    _MANAGER.start()
+                    _MANAGER.register_cleanup()
+    return _MANAGER
+
+
+def poke():
+    if _MANAGER is not None:
+        _MANAGER.poke()
+
+
+if enabled():
+    manager()
+
+
+if 'dice-virsh_utils.instrument' in sys.modules:
+    sys.modules['dice-virsh_utils.instrument'].install(sys.modules[__name__])
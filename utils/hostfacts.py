@@ -0,0 +1,76 @@
+import collections
+import re
+import threading
+
+HostFacts = collections.namedtuple('HostFacts', ['cpus', 'mem_total'])
+
+_FACTS = None
+_LOCK = threading.Lock()
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as fp:
+            return fp.read()
+    except IOError:
+        return None
+
+
+def parse_cpulist(text):
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return tuple(cpus)
+
+
+def _probe_cpus():
+    online = _read('/sys/devices/system/cpu/online')
+    if online:
+        return parse_cpulist(online)
+    cpuinfo = _read('/proc/cpuinfo') or ''
+    return tuple(int(cpu) for cpu in
+                 re.findall(r'^processor\s*:\s*(\d+)', cpuinfo, re.M))
+
+
+def _probe_meminfo():
+    meminfo = _read('/proc/meminfo') or ''
+    values = {}
+    for name, value in re.findall(r'^(\w+):\s*(\d+)', meminfo, re.M):
+        values[name] = int(value)
+    return values
+
+
+def probe():
+    # Read once per process; all values are in CPU ids or KiB.
+    return HostFacts(
+        cpus=_probe_cpus(),
+        mem_total=_probe_meminfo().get('MemTotal', 0),
+    )
+
+
+def facts():
+    global _FACTS
+    if _FACTS is None:
+        with _LOCK:
+            if _FACTS is None:
+                _FACTS = probe()
+    return _FACTS
+
+
+def reset():
+    global _FACTS
+    _FACTS = None
+
+
+def cpus():
+    return facts().cpus
+
+
+def mem_total():
+    return facts().mem_total
@@ -0,0 +1,233 @@
+import atexit
+import functools
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+PROFILE = os.environ.get('DICE_VIRSH_PROFILE', '')
+
+PROFILE_OUT = os.environ.get('DICE_VIRSH_PROFILE_OUT', '')
+
+SAMPLE_LIMIT = 10000
+
+TARGETS = {
+    'virsh': [
+        'load_commands', 'CommandCatalog._load', 'load_cmds_from_help',
+        'build_catalog', 'refresh_catalog', 'options', 'required_options',
+        'exclusive_options', 'classify_options', 'sample_options', 'argtype',
+        'string_domname', 'string_domname_running', 'string_domname_paused',
+        'string_domname_shutoff', 'string_domname_rop', 'string_poolname',
+        'string_poolname_ina', 'string_poolname_act', 'string_netname',
+        'string_netname_ina', 'string_netname_act', 'string_volname',
+    ],
+    'buildscript': [
+        'arg_build', 'xml_complete',
+    ],
+    'utils_xml_gen': [
+        'process_overide', 'load_schema', 'generate_domain',
+    ],
+    'item': [
+        'Item.run',
+    ],
+    'fixtures': [
+        'FixtureManager.replenish', 'FixtureManager.define',
+    ],
+}
+
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.forks = 0
+        self.samples = []
+        # A private generator keeps the global random stream, and with it
+        # seeded generation, unaffected by profiling.
+        self._random = random.Random()
+
+    def add(self, elapsed, failed):
+        self.calls += 1
+        self.total += elapsed
+        if failed:
+            self.errors += 1
+        if len(self.samples) < SAMPLE_LIMIT:
+            self.samples.append(elapsed)
+        else:
+            # Reservoir sampling keeps percentiles unbiased on long runs.
+            idx = self._random.randint(0, self.calls - 1)
+            if idx < SAMPLE_LIMIT:
+                self.samples[idx] = elapsed
+
+    def percentile(self, pct):
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        idx = min(len(samples) - 1, int(round(pct / 100.0 * len(samples))))
+        return samples[idx]
+
+    def summary(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'total': self.total,
+            'mean': self.total / self.calls if self.calls else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'forks': self.forks,
+        }
+
+
+class Recorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.forks = 0
+        self.started = time.time()
+        self.local = threading.local()
+        self.main_stack = []
+
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            if threading.current_thread().name == 'MainThread':
+                self.local.stack = self.main_stack
+            else:
+                self.local.stack = []
+        return self.local.stack
+
+    def enter(self, name):
+        self._stack().append(name)
+
+    def leave(self, name, elapsed, failed):
+        self._stack().pop()
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = StageStats(name)
+            self.stages[name].add(elapsed, failed)
+
+    def fork(self):
+        # Forks count towards every stage active on this thread. Worker
+        # threads (help fetches, reconciler transitions) run outside any
+        # stage of their own, so theirs go to the stages open on the main
+        # thread that is waiting on them.
+        stack = self._stack() or list(self.main_stack)
+        with self.lock:
+            self.forks += 1
+            for name in set(stack):
+                if name not in self.stages:
+                    self.stages[name] = StageStats(name)
+                self.stages[name].forks += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'uptime': time.time() - self.started,
+                'forks': self.forks,
+                'stages': dict((name, stats.summary())
+                               for name, stats in self.stages.items()),
+            }
+
+
+RECORDER = Recorder()
+
+
+def enabled():
+    return bool(PROFILE)
+
+
+def timed(name):
+    def _decorator(function):
+        @functools.wraps(function)
+        def _inner(*args, **kargs):
+            RECORDER.enter(name)
+            start = time.time()
+            failed = True
+            try:
+                result = function(*args, **kargs)
+                failed = False
+                return result
+            finally:
+                RECORDER.leave(name, time.time() - start, failed)
+        _inner.instrumented = True
+        return _inner
+    return _decorator
+
+
+def install(module):
+    if not enabled():
+        return
+    short_name = module.__name__.rsplit('.', 1)[-1]
+    for path in TARGETS.get(short_name, []):
+        owner = module
+        parts = path.split('.')
+        for part in parts[:-1]:
+            owner = getattr(owner, part, None)
+        function = getattr(owner, parts[-1], None)
+        if function is None or getattr(function, 'instrumented', False):
+            continue
+        setattr(owner, parts[-1],
+                timed('%s.%s' % (short_name, path))(function))
+
+
+def install_all():
+    for short_name in TARGETS:
+        module = sys.modules.get('dice-virsh_utils.' + short_name)
+        if module is not None:
+            install(module)
+
+
+def snapshot():
+    return RECORDER.snapshot()
+
+
+def format_summary(snap):
+    lines = ['%-40s %8s %10s %9s %9s %9s %9s %7s' % (
+        'stage', 'calls', 'total(s)', 'mean(ms)', 'p50(ms)', 'p90(ms)',
+        'p99(ms)', 'forks')]
+    stages = sorted(snap['stages'].items(), key=lambda item: -item[1]['total'])
+    for name, stats in stages:
+        lines.append('%-40s %8d %10.3f %9.2f %9.2f %9.2f %9.2f %7d' % (
+            name, stats['calls'], stats['total'], stats['mean'] * 1000,
+            stats['p50'] * 1000, stats['p90'] * 1000, stats['p99'] * 1000,
+            stats['forks']))
+    lines.append('total forks: %d in %.1fs' % (snap['forks'], snap['uptime']))
+    return '\n'.join(lines) + '\n'
+
+
+def dump(path=None):
+    snap = snapshot()
+    path = path or PROFILE_OUT
+    if path:
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as fp:
+            json.dump(snap, fp, indent=2, sort_keys=True)
+        os.rename(tmp_path, path)
+    else:
+        sys.stderr.write(format_summary(snap))
+    return snap
+
+
+def _count_forks():
+    popen_init = subprocess.Popen.__init__
+
+    @functools.wraps(popen_init)
+    def _init(self, *args, **kargs):
+        RECORDER.fork()
+        popen_init(self, *args, **kargs)
+    subprocess.Popen.__init__ = _init
+
+
+if enabled():
+    _count_forks()
+    install_all()
+    atexit.register(dump)
+    if (hasattr(signal, 'SIGUSR1') and
+            threading.current_thread().name == 'MainThread'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: dump())
@@ -1,41 +1,88 @@
 from dice.core import item
 from dice import utils
+import os
 import re
+import sys
+import tempfile
+import time
 
 DICE_SIGNATURE = 'JunLi'
 
+XML_PLACEHOLDER_RE = re.compile('"(' + DICE_SIGNATURE + '.+?_.+?)"')
+
 
 class Item(item.ItemBase):
-    def run(self):
-        def replacexml(self, xml=None):
-            fs = open(xml, 'r').read()
-            xmlreq = re.findall('"(' + DICE_SIGNATURE + '.+?_.+?)"', fs)
-            for req in xmlreq:
-                if req is not None:
-                    reqvalue = utils.escape(str(self.get(req)))
-                    fs = fs.replace(req, reqvalue)
+    def replacexml(self, xml):
+        # Fill every placeholder in one pass and write the result to a
+        # private copy, leaving the shared source file untouched.
+        def _value(match):
+            return '"%s"' % utils.escape(str(self.get(match.group(1))))
+
+        with open(xml, 'r') as fp:
+            content = XML_PLACEHOLDER_RE.sub(_value, fp.read())
 
-            open(xml, 'w').write(fs)
+        fd, path = tempfile.mkstemp(
+            prefix='dice-virsh-', suffix='-' + os.path.basename(xml))
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(content)
+        return path
+
+    def run(self):
+        xml_copies = {}
+        try:
+            self._run(xml_copies)
+        finally:
+            for path in xml_copies.values():
+                os.remove(path)
 
+    def _run(self, xml_copies):
         cmdline = 'virsh'
         cmd = utils.escape(str(self.get('subcmd')))
         cmdline += ' %s' % cmd
+        # The journal keeps the source XML paths: the private copies are
+        # deleted as soon as the item has run.
+        journal_cmdline = cmdline
 
+        args = {}
         options = self.get('options')
         if options is not None:
             for opt in options:
                 cmdline += ' --%s' % utils.escape(str(opt))
+                journal_cmdline += ' --%s' % utils.escape(str(opt))
+                opt_name = str(opt)
                 opt = str(opt) + '_arg'
                 opt = opt.replace('-', '_')
                 arg = self.get(opt)
+                args[opt_name] = arg
 
                 if arg is None:
                     arg = ''
-                arg = utils.escape(str(arg))
-                if re.search('\.xml', arg):
-                    replacexml(self, arg)
+                arg = str(arg)
+                journal_cmdline += ' %s' % utils.escape(arg)
+                if '.xml' in arg and os.path.isfile(arg):
+                    if arg not in xml_copies:
+                        xml_copies[arg] = self.replacexml(arg)
+                    arg = xml_copies[arg]
+                arg = utils.escape(arg)
                 cmdline += ' %s' % arg
-        f = open('runlog', 'a')
-        f.write(cmdline + '\n')
-        f.close()
+        start = time.time()
         self.res = utils.run(cmdline)
+
+        journal_mod = sys.modules['dice-virsh_utils.journal']
+        journal_mod.record(
+            command=str(self.get('subcmd')),
+            cmdline=journal_cmdline,
+            args=args,
+            start=start,
+            end=time.time(),
+            exit_status=getattr(self.res, 'exit_status', None),
+            stdout_bytes=len(getattr(self.res, 'stdout', None) or ''),
+            stderr_bytes=len(getattr(self.res, 'stderr', None) or ''),
+        )
+
+        virsh_mod = sys.modules['dice-virsh_utils.virsh']
+        virsh_mod.invalidate_inventory(str(self.get('subcmd')))
+
+
+if 'dice-virsh_utils.instrument' in sys.modules:
+    sys.modules['dice-virsh_utils.instrument'].install(sys.modules[__name__])
@@ -0,0 +1,188 @@
+import atexit
+import fcntl
+import json
+import os
+import select
+import threading
+import time
+
+JOURNAL_PATH = os.environ.get('DICE_VIRSH_JOURNAL', 'runlog.jsonl')
+
+JOURNAL_MAX_BYTES = int(os.environ.get('DICE_VIRSH_JOURNAL_MAX_BYTES',
+                                       64 * 1024 ** 2))
+
+JOURNAL_BACKUPS = int(os.environ.get('DICE_VIRSH_JOURNAL_BACKUPS', 5))
+
+JOURNAL_FLUSH_INTERVAL = 1.0
+
+JOURNAL_BUFFER_BYTES = 64 * 1024
+
+# Longest write that concurrent O_APPEND writers cannot interleave.
+PIPE_BUF = getattr(select, 'PIPE_BUF', 512)
+
+JOURNAL_FSYNC_INTERVAL = 10.0
+
+
+class RunJournal(object):
+    # JSONL log shared by every DICE process writing to the same path.
+    # Records are buffered and flushed every JOURNAL_FLUSH_INTERVAL seconds
+    # as O_APPEND writes of whole lines, none longer than PIPE_BUF, so
+    # lines of concurrent processes never interleave. The file is fsynced
+    # every JOURNAL_FSYNC_INTERVAL and rotated by size under a lock file.
+    def __init__(self, path, max_bytes=JOURNAL_MAX_BYTES,
+                 backups=JOURNAL_BACKUPS,
+                 flush_interval=JOURNAL_FLUSH_INTERVAL,
+                 fsync_interval=JOURNAL_FSYNC_INTERVAL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._fd = None
+        self._pending = []
+        self._pending_bytes = 0
+        self._dirty = False
+        self._synced = time.time()
+        self._flusher = None
+
+    def _open(self):
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                           0o644)
+
+    def _reopen_if_rotated(self):
+        # Another process may have renamed the file this fd still points to.
+        try:
+            ino = os.stat(self.path).st_ino
+        except OSError:
+            ino = None
+        if ino != os.fstat(self._fd).st_ino:
+            os.close(self._fd)
+            self._open()
+
+    def _rotate(self):
+        with open(self.path + '.lock', 'a') as lock_fp:
+            fcntl.flock(lock_fp.fileno(), fcntl.LOCK_EX)
+            try:
+                # Skip it if another process rotated while this one waited.
+                try:
+                    size = os.stat(self.path).st_size
+                except OSError:
+                    size = 0
+                if size >= self.max_bytes:
+                    if self.backups > 0:
+                        for idx in range(self.backups - 1, 0, -1):
+                            src = '%s.%d' % (self.path, idx)
+                            if os.path.exists(src):
+                                os.rename(src,
+                                          '%s.%d' % (self.path, idx + 1))
+                        os.rename(self.path, self.path + '.1')
+                    else:
+                        os.remove(self.path)
+            finally:
+                fcntl.flock(lock_fp.fileno(), fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._open()
+
+    def _start_flusher(self):
+        def _loop():
+            while True:
+                time.sleep(self.flush_interval)
+                self.flush()
+
+        self._flusher = threading.Thread(target=_loop,
+                                         name='dice-virsh-journal')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    @staticmethod
+    def _line(entry):
+        line = json.dumps(entry, sort_keys=True, default=str) + '\n'
+        if len(line) <= PIPE_BUF:
+            return line
+        # Too long for one atomic write: keep the summary fields and as
+        # much of the command line as fits.
+        entry = dict(entry, truncated=True)
+        entry.pop('args', None)
+        cmdline = str(entry.get('cmdline', ''))
+        while True:
+            entry['cmdline'] = cmdline
+            line = json.dumps(entry, sort_keys=True, default=str) + '\n'
+            if len(line) <= PIPE_BUF or not cmdline:
+                return line
+            cmdline = cmdline[:len(cmdline) // 2]
+
+    def record(self, **entry):
+        line = self._line(entry)
+        with self._lock:
+            if self._flusher is None:
+                self._start_flusher()
+            self._pending.append(line)
+            self._pending_bytes += len(line)
+            if self._pending_bytes >= JOURNAL_BUFFER_BYTES:
+                self._flush()
+
+    def _write_pending(self):
+        if self._fd is None:
+            self._open()
+        else:
+            self._reopen_if_rotated()
+        chunk = ''
+        for line in self._pending:
+            if chunk and len(chunk) + len(line) > PIPE_BUF:
+                os.write(self._fd, chunk.encode('utf-8'))
+                chunk = ''
+            chunk += line
+        os.write(self._fd, chunk.encode('utf-8'))
+        self._pending = []
+        self._pending_bytes = 0
+        self._dirty = True
+
+    def _flush(self, fsync=False):
+        if self._pending:
+            self._write_pending()
+            if os.fstat(self._fd).st_size >= self.max_bytes:
+                os.fsync(self._fd)
+                self._rotate()
+                self._dirty = False
+        if not self._dirty:
+            return
+        now = time.time()
+        if fsync or now - self._synced >= self.fsync_interval:
+            os.fsync(self._fd)
+            self._synced = now
+            self._dirty = False
+
+    def flush(self, fsync=False):
+        with self._lock:
+            self._flush(fsync=fsync)
+
+    def close(self):
+        with self._lock:
+            self._flush(fsync=True)
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+_JOURNAL = None
+_JOURNAL_LOCK = threading.Lock()
+
+
+def journal():
+    global _JOURNAL
+    if _JOURNAL is None:
+        with _JOURNAL_LOCK:
+            if _JOURNAL is None:
+                _JOURNAL = RunJournal(JOURNAL_PATH)
+                atexit.register(_JOURNAL.close)
+    return _JOURNAL
+
+
+def record(**entry):
+    journal().record(**entry)
+
+
+def close():
+    if _JOURNAL is not None:
+        _JOURNAL.close()
@@ -0,0 +1,132 @@
+import collections
+import logging
+import multiprocessing
+import os
+import sys
+from multiprocessing.pool import ThreadPool
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+SCHEDULER_WORKERS = int(os.environ.get('DICE_VIRSH_WORKERS',
+                                       multiprocessing.cpu_count()))
+
+OBJECT_KINDS = [
+    ('domname', 'dom'),
+    ('poolname', 'pool'),
+    ('netname', 'net'),
+    ('volname', 'vol'),
+]
+
+
+def item_resources(item):
+    # Objects named by the resolved *_arg values, and whether the subcommand
+    # changes host state.
+    virsh_mod = sys.modules['dice-virsh_utils.virsh']
+    subcmd = str(item.get('subcmd'))
+    keys = set()
+    for opt in item.get('options') or []:
+        try:
+            otype = virsh_mod.argtype(subcmd, str(opt))
+        except KeyError:
+            continue
+        kinds = [kind for name, kind in OBJECT_KINDS if name in otype]
+        if not kinds:
+            continue
+
+        arg = item.get((str(opt) + '_arg').replace('-', '_'))
+        if arg is None:
+            continue
+        if not isinstance(arg, (list, tuple)):
+            arg = [arg]
+        for value in arg:
+            keys.add((kinds[0], str(value)))
+    return frozenset(keys), virsh_mod.changes_state(subcmd)
+
+
+class Claim(object):
+    def __init__(self, item):
+        self.item = item
+        self.keys, self.changes_state = item_resources(item)
+        # A state-changing command that names no object may touch anything.
+        self.exclusive = self.changes_state and not self.keys
+
+
+class Scheduler(object):
+    def __init__(self, workers=None):
+        self.workers = workers or SCHEDULER_WORKERS
+        self._busy = set()
+        self._running = 0
+        self._exclusive = False
+
+    def _runnable(self, claim, blocked, skipped):
+        if self._exclusive:
+            return False
+        if claim.exclusive:
+            return not self._running and not skipped
+        return not (claim.keys & self._busy) and not (claim.keys & blocked)
+
+    def _dispatch(self, pending, pool, done):
+        blocked = set()
+        skipped = False
+        for claim in list(pending):
+            if self._running >= self.workers:
+                break
+            if not self._runnable(claim, blocked, skipped):
+                if claim.exclusive:
+                    # Nothing may overtake an item that needs the whole host.
+                    break
+                blocked |= claim.keys
+                skipped = True
+                continue
+
+            pending.remove(claim)
+            self._busy |= claim.keys
+            self._exclusive = claim.exclusive
+            self._running += 1
+            pool.apply_async(_run_claim, (claim, done))
+
+    def run(self, items):
+        pending = collections.deque(Claim(item) for item in items)
+        done = queue.Queue()
+        error = None
+        pool = ThreadPool(self.workers)
+        try:
+            while True:
+                if error is None:
+                    self._dispatch(pending, pool, done)
+                if not self._running:
+                    break
+                claim, exc = done.get()
+                self._busy -= claim.keys
+                self._exclusive = False
+                self._running -= 1
+                if exc is None:
+                    yield claim.item
+                elif error is None:
+                    error = exc
+        finally:
+            pool.close()
+            pool.join()
+        if error is not None:
+            raise error
+
+
+def _run_claim(claim, done):
+    try:
+        claim.item.run()
+    except Exception as detail:
+        logging.exception('Failed to run %s', claim.item.get('subcmd'))
+        done.put((claim, detail))
+    else:
+        done.put((claim, None))
+
+
+def run_items(items, workers=None):
+    # DICE core calls Item.run() one item at a time, so nothing here runs
+    # concurrently by itself. A driver holding a batch of generated items
+    # passes them here instead and consumes the yielded items as they
+    # complete.
+    return Scheduler(workers).run(items)
@@ -0,0 +1,199 @@
+import atexit
+import fcntl
+import logging
+import os
+import re
+import select
+import subprocess
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+SESSION_POOL_SIZE = int(os.environ.get('DICE_VIRSH_SESSIONS', 0))
+
+SESSION_TIMEOUT = float(os.environ.get('DICE_VIRSH_SESSION_TIMEOUT', 60))
+
+# The marker is echoed as two words, so the line virsh prints for it never
+# matches the command text an interactive shell may echo back.
+SESSION_MARKER = ('dice-virsh-session', '%d-%d')
+
+PROMPT_RE = re.compile(r'^(virsh [#>] )+', re.M)
+
+
+class SessionResult(object):
+    # The interactive shell keeps no per-command exit status, so a result
+    # only says whether the output was read back in full. Commands whose
+    # status matters are run one-shot instead.
+    def __init__(self, cmdline, stdout='', stderr='', completed=False,
+                 duration=0.0):
+        self.cmdline = cmdline
+        self.stdout = stdout
+        self.stderr = stderr
+        self.completed = completed
+        self.duration = duration
+
+    def __repr__(self):
+        return '<SessionResult %r completed=%r>' % (
+            self.cmdline, self.completed)
+
+
+class SessionError(Exception):
+    pass
+
+
+class VirshSession(object):
+    # One long-lived interactive virsh shell. Each command is followed by
+    # an 'echo <marker>' so the end of its output can be found on stdout.
+    def __init__(self):
+        self.proc = None
+        self.serial = 0
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def spawn(self):
+        self.close()
+        self.proc = subprocess.Popen(
+            ['virsh', '--quiet'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            close_fds=True)
+        for fp in (self.proc.stdout, self.proc.stderr):
+            flags = fcntl.fcntl(fp.fileno(), fcntl.F_GETFL)
+            fcntl.fcntl(fp.fileno(), fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def close(self, graceful=True):
+        if self.proc is None:
+            return
+        proc, self.proc = self.proc, None
+        if proc.poll() is None and graceful:
+            try:
+                proc.stdin.write(b'quit\n')
+                proc.stdin.flush()
+            except (IOError, OSError):
+                pass
+            deadline = time.time() + 1
+            while proc.poll() is None and time.time() < deadline:
+                time.sleep(0.01)
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        for fp in (proc.stdin, proc.stdout, proc.stderr):
+            fp.close()
+
+    def _read_until(self, marker, timeout):
+        fds = {
+            self.proc.stdout.fileno(): [],
+            self.proc.stderr.fileno(): [],
+        }
+        out_fd = self.proc.stdout.fileno()
+        # A complete line, possibly behind prompts; anything after it is
+        # the next prompt and is dropped.
+        marker_re = re.compile(b'^(?:virsh [#>] )*' +
+                               re.escape(marker.encode('utf-8')) + b'\n',
+                               re.M)
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise SessionError('timed out after %ss' % timeout)
+            readable, _, _ = select.select(list(fds), [], [], remaining)
+            for fd in readable:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    raise SessionError('virsh session exited unexpectedly')
+                fds[fd].append(chunk)
+            out = b''.join(fds[out_fd])
+            match = marker_re.search(out)
+            if match:
+                # stderr is unbuffered, so it is complete once the marker
+                # printed after the command has arrived on stdout.
+                err_fd = self.proc.stderr.fileno()
+                while select.select([err_fd], [], [], 0)[0]:
+                    chunk = os.read(err_fd, 65536)
+                    if not chunk:
+                        break
+                    fds[err_fd].append(chunk)
+                return out[:match.start()], b''.join(fds[err_fd])
+
+    def run(self, command, timeout=SESSION_TIMEOUT):
+        if not self.alive():
+            self.spawn()
+        self.serial += 1
+        prefix, serial = SESSION_MARKER
+        serial = serial % (os.getpid(), self.serial)
+        echo = "echo '%s' '%s'" % (prefix, serial)
+        payload = '%s\n%s\n' % (command, echo)
+        self.proc.stdin.write(payload.encode('utf-8'))
+        self.proc.stdin.flush()
+
+        out, err = self._read_until('%s %s' % (prefix, serial), timeout)
+        lines = []
+        for line in out.decode('utf-8', 'replace').splitlines(True):
+            line = PROMPT_RE.sub('', line)
+            if line.rstrip('\n') in (command, echo):
+                # Input echoed back by the shell.
+                continue
+            lines.append(line)
+        return ''.join(lines), err.decode('utf-8', 'replace')
+
+
+class SessionPool(object):
+    def __init__(self, size):
+        self.size = size
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(VirshSession())
+
+    def run(self, cmdline, timeout=SESSION_TIMEOUT):
+        command = cmdline
+        if command.startswith('virsh '):
+            command = command[len('virsh '):]
+
+        session = self._idle.get()
+        start = time.time()
+        try:
+            try:
+                out, err = session.run(command, timeout=timeout)
+                completed = True
+            except (SessionError, IOError, OSError) as detail:
+                logging.warning('virsh session failed on %r: %s',
+                                cmdline, detail)
+                session.close(graceful=False)
+                out, err = '', str(detail)
+                completed = False
+            return SessionResult(cmdline, out, err, completed,
+                                 time.time() - start)
+        finally:
+            self._idle.put(session)
+
+    def close(self):
+        for _ in range(self.size):
+            self._idle.get().close()
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def enabled():
+    return SESSION_POOL_SIZE > 0
+
+
+def pool():
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = SessionPool(SESSION_POOL_SIZE)
+                atexit.register(_POOL.close)
+    return _POOL
+
+
+def run(cmdline, timeout=SESSION_TIMEOUT):
+    return pool().run(cmdline, timeout=timeout)
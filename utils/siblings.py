@@ -0,0 +1,27 @@
+import os
+import sys
+
+UTILS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_sibling(name):
+    # Loads utils/<name>.py under the module name DICE gives it, for entry
+    # points (scripts, benchmarks) that run outside DICE.
+    mod_name = 'dice-virsh_utils.' + name
+    if mod_name in sys.modules:
+        return sys.modules[mod_name]
+    path = os.path.join(UTILS_DIR, name + '.py')
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source(mod_name, path)
+    spec = importlib.util.spec_from_file_location(mod_name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[mod_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+if 'dice-virsh_utils.instrument' in sys.modules:
+    sys.modules['dice-virsh_utils.instrument'].install(sys.modules[__name__])
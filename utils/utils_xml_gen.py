@@ -1,3 +1,4 @@
+import argparse
 import sys
 import re
 import logging
@@ -5,10 +6,18 @@ import random
 import struct
 import socket
 import importlib
+import multiprocessing
+import hashlib
+import json
 import os
 import xml.etree.ElementTree as etree
 xml_gen = importlib.import_module('dice.utils.xml_gen')
 utils_random = importlib.import_module('dice.utils.rnd')
+data_dir = importlib.import_module('dice.utils.data_dir')
+
+SCHEMA_SNAPSHOT_VERSION = 2
+
+_SCHEMAS = {}
 
 
 UNIT_MAP = {
@@ -209,49 +218,355 @@ def startable(function):
     return _inner
 
 
-def load_rng(file_name, is_root=True):
+def parse_rng(file_name, is_root=True, files=None):
     xml_str = open(file_name).read()
+    if files is not None:
+        files[file_name] = _file_hash(xml_str)
     xml_str = re.sub(' xmlns="[^"]+"', '', xml_str, count=1)
     nodetree = etree.fromstring(xml_str)
     xml_path = os.path.dirname(file_name)
     for node in nodetree.findall('./include'):
         rng_name = os.path.join(xml_path, node.attrib['href'])
         nodetree.remove(node)
-        for element in load_rng(rng_name, is_root=False):
+        for element in parse_rng(rng_name, is_root=False, files=files):
             nodetree.insert(0, element)
-    return nodetree if is_root else nodetree.getchildren()
+    return nodetree if is_root else list(nodetree)
+
+
+def load_rng(file_name, is_root=True, files=None):
+    # A schema's root is served from load_schema(), already resolved and
+    # shared by every caller; node_overide() on it is then a no-op.
+    if is_root and files is None:
+        return load_schema(file_name).nodetree
+    return parse_rng(file_name, is_root=is_root, files=files)
+
+
+def define_index(nodetree):
+    defines = {}
+    for node in nodetree.findall('./define'):
+        defines.setdefault(node.get('name'), node)
+    return defines
+
 
+def overide_file(rng):
+    return os.path.abspath(os.path.split(rng)[1] + '_overides.xml')
 
-def node_overide(rng, nodetree):
-    fname = os.path.split(rng)[1] + '_overides.xml'
-    for element in load_rng(fname, is_root=False):
+
+def node_overide(rng, nodetree, defines=None, files=None):
+    schema = _SCHEMAS.get(os.path.abspath(rng))
+    if schema is not None and schema.nodetree is nodetree:
+        return
+    if defines is None:
+        defines = define_index(nodetree)
+    for element in parse_rng(overide_file(rng), is_root=False, files=files):
         name = element.get('name')
-        node = nodetree.find('./define[@name="%s"]' % name)
+        node = defines.get(name)
         if node is not None:
             nodetree.remove(node)
 
         nodetree.insert(0, element)
+        defines[name] = element
+
+
+class Schema(object):
+    def __init__(self, rng, nodetree, files):
+        self.rng = rng
+        self.nodetree = nodetree
+        self.files = files
+        self.defines = define_index(nodetree)
+
+    def define(self, name):
+        return self.defines.get(name)
+
+    def is_current(self):
+        for file_name, digest in self.files.items():
+            if digest is None:
+                if os.path.exists(file_name):
+                    return False
+                continue
+            try:
+                with open(file_name) as fp:
+                    if _file_hash(fp.read()) != digest:
+                        return False
+            except IOError:
+                return False
+        return True
+
+
+def _file_hash(content):
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def _snapshot_path(rng):
+    name = 'schema-%s.json' % hashlib.sha1(
+        rng.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(data_dir.USER_BASE_DIR, name)
+
+
+def _load_snapshot(rng):
+    path = _snapshot_path(rng)
+    try:
+        with open(path, 'r') as fp:
+            snapshot = json.load(fp)
+        if snapshot.get('version') != SCHEMA_SNAPSHOT_VERSION:
+            return None
+        nodetree = etree.fromstring(snapshot['xml'].encode('utf-8'))
+    except (IOError, ValueError, KeyError, AttributeError,
+            etree.ParseError):
+        return None
+    schema = Schema(rng, nodetree, snapshot['files'])
+    if not schema.is_current():
+        return None
+    return schema
+
+
+def _save_snapshot(schema):
+    path = _snapshot_path(schema.rng)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    snapshot = {
+        'version': SCHEMA_SNAPSHOT_VERSION,
+        'files': schema.files,
+        'xml': etree.tostring(schema.nodetree).decode('utf-8'),
+    }
+    try:
+        with open(tmp_path, 'w') as fp:
+            json.dump(snapshot, fp)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        logging.warning('Failed to save schema snapshot to %s', path)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_schema(rng):
+    # Resolved schema with includes and overides applied. Cached in process
+    # and as a JSON snapshot of the resolved XML, checked against the
+    # hashes of every file it was built from.
+    rng = os.path.abspath(rng)
+    if rng in _SCHEMAS:
+        return _SCHEMAS[rng]
+
+    schema = _load_snapshot(rng)
+    if schema is None:
+        files = {}
+        nodetree = parse_rng(rng, files=files)
+        defines = define_index(nodetree)
+        if os.path.exists(overide_file(rng)):
+            node_overide(rng, nodetree, defines=defines, files=files)
+        else:
+            files[overide_file(rng)] = None
+        schema = Schema(rng, nodetree, files)
+        _save_snapshot(schema)
+    _SCHEMAS[rng] = schema
+    return schema
+
+
+class OverideDispatch(object):
+    # Per-tag matcher built once from OVERIDE_MAP. Literal XML paths are
+    # looked up in a dict, regex paths are pre-filtered by one combined
+    # alternation, and matches keep the declaration order of the map.
+    LITERAL_RE = re.compile(r'^[\w/-]*$')
+
+    def __init__(self, tag, entries):
+        self.handler = globals().get('Process' + tag.capitalize())
+        self.func_names = []
+        self.node_patts = []
+        self.literals = {}
+        self.patterns = []
+        self.anywhere = []
+        for idx, (xml_patt, node_patt, func_name) in enumerate(entries):
+            self.func_names.append(func_name)
+            self.node_patts.append(
+                None if node_patt is None else _full_match(node_patt))
+            if xml_patt is None:
+                self.anywhere.append(idx)
+            elif self.LITERAL_RE.match(xml_patt):
+                self.literals.setdefault(xml_patt, []).append(idx)
+            else:
+                self.patterns.append((idx, _full_match(xml_patt)))
+
+        self.combined = None
+        if self.patterns:
+            self.combined = _full_match('|'.join(
+                '(?:%s)' % entries[idx][0] for idx, _ in self.patterns))
+
+    def match(self, xml_path, node_path):
+        indices = self.literals.get(xml_path, [])
+        if self.combined is not None and self.combined.match(xml_path):
+            indices = indices + [idx for idx, patt in self.patterns
+                                 if patt.match(xml_path)]
+        if self.anywhere:
+            indices = indices + self.anywhere
+        if len(indices) > 1:
+            indices = sorted(indices)
+        return [self.func_names[idx] for idx in indices
+                if self.node_patts[idx] is None or
+                self.node_patts[idx].match(node_path)]
+
+
+def _full_match(patt):
+    return re.compile('^(?:%s)$' % patt)
+
+
+def compile_overides():
+    return dict((tag, OverideDispatch(tag, entries))
+                for tag, entries in OVERIDE_MAP.items())
 
 
 def process_overide(tag, xml_path, node_path, node, params):
     logging.debug('%s %s %s', tag, xml_path, node_path)
-    if tag not in OVERIDE_MAP:
+    if tag not in OVERIDE_DISPATCH:
         logging.error('Unknown tag %s' % tag)
         return
 
     cont = True
     result = None
-    for xml_patt, node_patt, func_name in OVERIDE_MAP[tag]:
-        if xml_patt is None or re.match('^' + xml_patt + '$', xml_path):
-            if node_patt is None or re.match('^' + node_patt + '$', node_path):
-                cls_name = 'Process' + tag.capitalize()
-                process_instance = globals()[cls_name]()
-                cont, result = process_instance.process(
-                    func_name, node, xml_path, node_path, params)
+    dispatch = OVERIDE_DISPATCH[tag]
+    for func_name in dispatch.match(xml_path, node_path):
+        process_instance = dispatch.handler()
+        cont, result = process_instance.process(
+            func_name, node, xml_path, node_path, params)
 
     return cont, result
 
 
+class XmlIndex(object):
+    # Incremental index over the domain being generated, fed by
+    # IndexedStack as elements are pushed on params['xml_stack'].
+    def __init__(self):
+        self.root = None
+        self.stack = []
+        self._reset()
+
+    def _reset(self):
+        self.by_tag = {}
+        self.by_parent_tag = {}
+        self.parents = {}
+        self.kids = {}
+        self._found = {}
+
+    def add(self, element, parent=None):
+        if element in self.parents:
+            return
+        if self.root is None:
+            self.root = element
+        parent_tag = parent.tag if parent is not None else None
+        self.by_tag.setdefault(element.tag, []).append(element)
+        self.by_parent_tag.setdefault(
+            (element.tag, parent_tag), []).append(element)
+        self.parents[element] = parent
+        if parent is not None:
+            self.kids.setdefault(parent, []).append(element)
+
+    def add_tree(self, element, parent=None):
+        self.add(element, parent)
+        for child in element:
+            self.add_tree(child, element)
+
+    def discard(self, element):
+        if element not in self.parents:
+            return
+        for child in list(self.kids.get(element, [])):
+            self.discard(child)
+        parent = self.parents.pop(element)
+        parent_tag = parent.tag if parent is not None else None
+        self.by_tag[element.tag].remove(element)
+        self.by_parent_tag[(element.tag, parent_tag)].remove(element)
+        if parent is not None:
+            self.kids[parent].remove(element)
+        self.kids.pop(element, None)
+
+    def rebuild(self):
+        # Re-reads the tree after it was changed behind the index's back.
+        # Elements still on the stack may not be attached yet and are
+        # indexed under the element below them, as IndexedStack does.
+        self._reset()
+        if self.root is not None:
+            self.add_tree(self.root)
+        below = None
+        for element in self.stack:
+            self.add(element, below)
+            below = element
+
+    def state(self, element):
+        # 'attached' when the recorded parents still lead to the root,
+        # 'pending' when the break is an element on the stack that is not
+        # attached yet, and 'stale' when the tree changed behind the index.
+        while element is not self.root:
+            parent = self.parents.get(element)
+            if parent is None:
+                return 'stale'
+            if not any(child is element for child in parent):
+                if any(pushed is element for pushed in self.stack):
+                    return 'pending'
+                return 'stale'
+            element = parent
+        return 'attached'
+
+    def _matches(self, element, attrib, parent_tag, nested):
+        if element not in self.parents:
+            return False
+        if attrib is not None and element.get(attrib[0]) != attrib[1]:
+            return False
+        parent = self.parents[element]
+        if parent_tag is not None and (
+                parent is None or parent.tag != parent_tag):
+            return False
+        if nested and parent is self.root:
+            return False
+        return True
+
+    def _candidates(self, tag, parent_tag):
+        if parent_tag is None:
+            return self.by_tag.get(tag, [])
+        return self.by_parent_tag.get((tag, parent_tag), [])
+
+    def _find(self, key):
+        # Returns (element, stale).
+        tag, attrib, parent_tag, nested = key
+        element = self._found.get(key)
+        if element is not None and self._matches(
+                element, attrib, parent_tag, nested):
+            if self.state(element) == 'attached':
+                return element, False
+        for element in self._candidates(tag, parent_tag):
+            if not self._matches(element, attrib, parent_tag, nested):
+                continue
+            state = self.state(element)
+            if state == 'stale':
+                return None, True
+            if state == 'attached':
+                self._found[key] = element
+                return element, False
+        return None, False
+
+    def find(self, tag, attrib=None, parent_tag=None, nested=False):
+        # Only elements in the tree are returned, as ElementTree's find()
+        # would. A detached or moved element means the index is out of
+        # date, so it is rebuilt and the lookup retried once.
+        key = (tag, attrib, parent_tag, nested)
+        element, stale = self._find(key)
+        if stale:
+            self.rebuild()
+            element, stale = self._find(key)
+        return None if stale else element
+
+    def children(self, parent, tag):
+        return [child for child in self.kids.get(parent, [])
+                if child.tag == tag]
+
+
+class IndexedStack(list):
+    def __init__(self, index):
+        super(IndexedStack, self).__init__()
+        self.index = index
+        index.stack = self
+
+    def append(self, element):
+        self.index.add(element, self[-1] if self else None)
+        super(IndexedStack, self).append(element)
+
+
 class ProcessBase(object):
 
     def process(self, func_name, node, xml_path, node_path, params):
@@ -266,6 +581,8 @@ class ProcessBase(object):
             self.parent = self.xml_stack[-2]
         self.node = node
         self.nodetree = params['nodetree']
+        self.defines = params.get('defines')
+        self.index = params.get('xml_index')
         self.name = node.get('name')
         self.cont = False
 
@@ -276,11 +593,31 @@ class ProcessBase(object):
     def go_on(self):
         self.cont = True
 
+    def xml_find(self, path, tag, attrib=None, parent_tag=None,
+                 nested=False):
+        # ``path`` is the equivalent ElementTree query on the whole domain,
+        # used when the generator does not keep an XmlIndex.
+        if self.index is None:
+            return self.xml.find(path)
+        return self.index.find(tag, attrib=attrib, parent_tag=parent_tag,
+                               nested=nested)
+
+    def child_findall(self, parent, tag):
+        if self.index is None:
+            return parent.findall('./' + tag)
+        return self.index.children(parent, tag)
+
+    def find_define(self, name):
+        if self.defines is not None:
+            return self.defines.get(name)
+        return self.nodetree.find("./define[@name='%s']" % name)
+
     def get_max_vcpu(self):
         if 'max_vcpu' in self.params:
             cnt = self.params['max_vcpu']
         else:
-            cnt = self.params['max_vcpu'] = len(re.findall('processor.+?:.+?(\d+)', open('/proc/cpuinfo', 'r').read()))
+            host_mod = sys.modules['dice-virsh_utils.hostfacts']
+            cnt = self.params['max_vcpu'] = len(host_mod.cpus())
         return cnt
 
     def get_max_mem(self):
@@ -288,9 +625,9 @@ class ProcessBase(object):
             maxmem = self.params['maxmem']
             unit = self.params['maxmem_unit']
         else:
-            maxmem = utils_random.integer(1024 ** 2, eval(
-                re.findall('MemTotal.*?:.+?(\d+)',
-                           open('/proc/meminfo', 'r').read())[0]) * 1024)
+            host_mod = sys.modules['dice-virsh_utils.hostfacts']
+            maxmem = utils_random.integer(1024 ** 2,
+                                          host_mod.mem_total() * 1024)
             unit = 'eib'
             while maxmem <= UNIT_MAP[unit]:
                 unit = random.choice(list(UNIT_MAP.keys()))
@@ -384,7 +721,7 @@ class ProcessElement(ProcessBase):
     def seclabel(self):
         # TODO: Check whether all kind of seclabels are used.
         models = ['none', 'dac']
-        for seclabel in self.cur_xml.findall('./seclabel'):
+        for seclabel in self.child_findall(self.cur_xml, 'seclabel'):
             model = seclabel.get('model')
             if model is not None:
                 models.remove(model)
@@ -638,7 +975,7 @@ class ProcessAttribute(ProcessBase):
     def seclabel_model(self):
         # TODO: Add check for support of security
         models = ['none', 'dac']
-        for seclabel in self.parent.findall('./seclabel'):
+        for seclabel in self.child_findall(self.parent, 'seclabel'):
             model = seclabel.get('model')
             if model is not None:
                 models.remove(model)
@@ -812,16 +1149,22 @@ class ProcessOptional(ProcessBase):
         if self.node.find("./ref[@name='qemucmdline']") is None:
             return self.go_on()
 
-        controller = self.xml.find("./devices/controller[@type='pci']")
+        controller = self.xml_find("./devices/controller[@type='pci']",
+                                   'controller', attrib=('type', 'pci'),
+                                   parent_tag='devices')
         if controller is None:
-            node = self.nodetree.find("./define[@name='pciController']")
+            node = self.find_define('pciController')
             params = {
                 'xml_stack': [],
                 'node_stack': [],
                 'nodetree': self.nodetree,
+                'defines': self.defines,
             }
             pcinode = xml_gen.parse_node(node, params=params)
-            self.xml.find("./devices").append(pcinode)
+            devices = self.xml.find("./devices")
+            devices.append(pcinode)
+            if self.index is not None:
+                self.index.add_tree(pcinode, devices)
 
 
 class ProcessZeroormore(ProcessBase):
@@ -897,8 +1240,8 @@ class ProcessChoice(ProcessBase):
 
     @definable
     def seclabel(self):
-        labels = self.xml.findall('./devices//seclabel')
-        if not len(labels):
+        label = self.xml_find('./devices//seclabel', 'seclabel', nested=True)
+        if label is None:
             return self.go_on()
 
         for label_type in self.node.getchildren():
@@ -1044,13 +1387,17 @@ class ProcessChoice(ProcessBase):
 
         addr = self.cur_xml.find('./address')
         self.cur_xml.remove(addr)
+        if self.index is not None:
+            self.index.discard(addr)
         self.cur_xml.set('index', '0')
 
         expect_type = None
-        if self.xml.find("./devices//address[@type='pci']") is not None:
+        if self.xml_find("./devices//address[@type='pci']", 'address',
+                         attrib=('type', 'pci')) is not None:
             expect_type = 'pci-root'
-        if self.xml.find("./devices/controller"
-                         "[@model='dmi-to-pci-bridge']") is not None:
+        if self.xml_find("./devices/controller[@model='dmi-to-pci-bridge']",
+                         'controller', attrib=('model', 'dmi-to-pci-bridge'),
+                         parent_tag='devices') is not None:
             expect_type = 'pcie-root'
 
         for val in self.node.getchildren():
@@ -1123,3 +1470,110 @@ class ProcessChoice(ProcessBase):
         for val in self.node.getchildren():
             if val.text not in existing_ciphers:
                 self.choices.append(val)
+
+
+
+OVERIDE_DISPATCH = compile_overides()
+
+
+def generate_domain(schema, sanity='definable', seed=None):
+    if seed is not None:
+        random.seed(seed)
+    xml_index = XmlIndex()
+    params = {
+        'xml_stack': IndexedStack(xml_index),
+        'xml_index': xml_index,
+        'node_stack': [],
+        'nodetree': schema.nodetree,
+        'defines': schema.defines,
+        'sanity': sanity,
+    }
+    xml = xml_gen.parse_node(schema.nodetree.find('./start'), params=params)
+    return etree.tostring(xml)
+
+
+_WORKER_SCHEMA = None
+
+
+def _init_worker(rng):
+    global _WORKER_SCHEMA
+    _WORKER_SCHEMA = load_schema(rng)
+
+
+def _generate_task(task):
+    index, sanity, seed, out_dir = task
+    try:
+        xml = generate_domain(_WORKER_SCHEMA, sanity=sanity, seed=seed)
+    except Exception as detail:
+        return index, seed, None, '%s: %s' % (type(detail).__name__, detail)
+
+    if out_dir is None:
+        return index, seed, xml, None
+    path = os.path.join(out_dir, 'domain-%06d.xml' % index)
+    with open(path, 'wb') as fp:
+        fp.write(xml)
+    return index, seed, path, None
+
+
+def generate_domains(rng, count, sanity='definable', workers=None,
+                     seed=None, out_dir=None):
+    # Yield (index, seed, xml) as documents finish, or (index, seed, path)
+    # when out_dir is given. Every document gets its own seed, so a single
+    # one can be regenerated with generate_domain().
+    if seed is None:
+        seed = random.randint(0, 2**31 - 1)
+    if out_dir is not None and not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    tasks = ((index, sanity, seed + index, out_dir)
+             for index in range(count))
+
+    pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                initargs=(rng,))
+    try:
+        for index, task_seed, result, error in pool.imap_unordered(
+                _generate_task, tasks, chunksize=4):
+            if error is not None:
+                logging.warning('Failed to generate domain %d (seed %d): %s',
+                                index, task_seed, error)
+                continue
+            yield index, task_seed, result
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Generate domain XMLs in parallel.')
+    parser.add_argument('rng', nargs='?',
+                        default='/usr/share/libvirt/schemas/domain.rng')
+    parser.add_argument('-n', '--count', type=int, default=100)
+    parser.add_argument('-s', '--sanity', default='definable',
+                        choices=['none', 'definable', 'startable'])
+    parser.add_argument('-w', '--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('-o', '--out-dir', default='domxml')
+    args = parser.parse_args(argv)
+
+    # Run as a script, this directory is first on sys.path.
+    import siblings
+    siblings.load_sibling('hostfacts')
+    done = 0
+    for index, seed, path in generate_domains(
+            args.rng, args.count, sanity=args.sanity, workers=args.workers,
+            seed=args.seed, out_dir=args.out_dir):
+        done += 1
+        sys.stdout.write('%s %d\n' % (path, seed))
+    sys.stderr.write('Generated %d of %d domains\n' % (done, args.count))
+    return 0 if done else 1
+
+
+if 'dice-virsh_utils.instrument' in sys.modules:
+    sys.modules['dice-virsh_utils.instrument'].install(sys.modules[__name__])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
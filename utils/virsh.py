@@ -1,11 +1,39 @@
+import argparse
+import fcntl
+import gzip
+import hashlib
+import itertools
 import json
 import logging
+import mmap
 import os
+import random
 import re
+import struct
 import subprocess
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 from dice.utils import data_dir
 
+CATALOG_SCHEMA = 2
+
+HELP_WORKERS = int(os.environ.get('DICE_VIRSH_HELP_WORKERS', 8))
+
+CATALOG_FORMAT = os.environ.get('DICE_VIRSH_CATALOG_FORMAT', 'json')
+
+HELP_ARCHIVE = os.environ.get('DICE_VIRSH_HELP_ARCHIVE', '')
+
+INVENTORY_TTL = float(os.environ.get('DICE_VIRSH_INVENTORY_TTL', 2))
+
+RECONCILE_COUNT = int(os.environ.get('DICE_VIRSH_RECONCILE_COUNT', 1))
+
+RECONCILE_RETRIES = int(os.environ.get('DICE_VIRSH_RECONCILE_RETRIES', 3))
+
+RECONCILE_WORKERS = int(os.environ.get('DICE_VIRSH_RECONCILE_WORKERS', 4))
+
 EXCLUSIVE_OPTIONS = {
     'allocpages': [
         ('all', 'cellno'),
@@ -205,60 +233,124 @@ EXCLUSIVE_OPTIONS = {
     ],
 }
 
-DOMAIN_RUNNING = [
+DOMAIN_RUNNING = frozenset([
     'shutoff', 'suspend', 'set-user-password', 'domtime',
-]
+])
 
-DOMAIN_PAUSED = [
+DOMAIN_PAUSED = frozenset([
     'resume',
-]
+])
 
-DOMAIN_SHUTOFF = [
+DOMAIN_SHUTOFF = frozenset([
     'start', 'domrename', 'setmaxmem', 'setmem', 'setvcpus',
-]
+])
 
-DOMAIN_RoP = [
+DOMAIN_RoP = frozenset([
     'destroy', 'cpu-stats', 'domdisplay' 'domjobinfo', 'send-key',
     'qemu-monitor-command', 'qemu-monitor-event', 'qemu-agent-command',
     'reboot', 'reset', 'save', 'screenshot', 'vncdisplay', 'domblkerror',
     'domblkstat', 'domcontrol', 'dommemstat',
-]
+])
 
-POOL_INA = [
+POOL_INA = frozenset([
     'pool-delete', 'pool-build', 'pool-undefine', 'migrate-compcache',
     'migrate-setmaxdowntime',
-]
+])
+
+
+INVENTORY_COMMANDS = frozenset([
+    'create', 'define', 'destroy', 'domrename', 'managedsave', 'restore',
+    'resume', 'save', 'shutdown', 'start', 'suspend', 'undefine',
+    'net-create', 'net-define', 'net-destroy', 'net-start', 'net-undefine',
+    'pool-build', 'pool-create', 'pool-create-as', 'pool-define',
+    'pool-define-as', 'pool-delete', 'pool-destroy', 'pool-start',
+    'pool-undefine', 'vol-clone', 'vol-create', 'vol-create-as',
+    'vol-create-from', 'vol-delete', 'vol-upload', 'vol-wipe',
+])
 
+STATE_COMMANDS = INVENTORY_COMMANDS | frozenset([
+    'domtime', 'reboot', 'reset', 'set-user-password', 'setmaxmem',
+    'setmem', 'setvcpus', 'migrate-compcache', 'migrate-setmaxdowntime',
+])
 
-XML_DOMAIN = [
+
+XML_DOMAIN = frozenset([
     'define',
-]
+])
 
 
-XML_NET = [
+XML_NET = frozenset([
 
-]
+])
 
 
-XML_POOL = [
+XML_POOL = frozenset([
 
-]
+])
 
 
-XML_VOL = [
+XML_VOL = frozenset([
 
-]
+])
 
 
-XML_NETFLT = [
+XML_NETFLT = frozenset([
 
-]
+])
+
+
+XML_IF = frozenset([
+
+])
 
 
-XML_IF = [
+def _argtype_rules():
+    # Digest of the command sets argtype resolution depends on, so a stored
+    # argtype table is rebuilt when they are edited.
+    rules = [DOMAIN_RUNNING, DOMAIN_PAUSED, DOMAIN_SHUTOFF, DOMAIN_RoP,
+             POOL_INA, XML_DOMAIN, XML_NET, XML_POOL, XML_VOL, XML_NETFLT,
+             XML_IF]
+    blob = json.dumps([sorted(rule) for rule in rules])
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()
 
+
+ARGTYPE_RULES = _argtype_rules()
+
+
+# Classification of <string> options by their help line, highest priority
+# first; each rule is a lookahead expression matched against the whole line.
+# Lines no rule matches get the default type of their value token.
+OPTION_TYPE_RULES = [
+    ('string_domname', r'(?=.*(?:domain name|list of domain))(?!.*new)'),
+    ('string_nstring', r'(?=.*domain)(?=.*uuid)'),
+    ('string_poolname', r'(?=.*pool name)'),
+    ('string_volname', r'(?=.*vol(?:ume)? name)'),
+    ('string_netname', r'(?=.*network)(?=.*name)'),
 ]
 
+OPTION_TYPE_RE = re.compile('|'.join(
+    '(?P<rule%d>%s)' % (idx, rule)
+    for idx, (_, rule) in enumerate(OPTION_TYPE_RULES)))
+
+OPTION_RULE_TYPES = dict(
+    ('rule%d' % idx, otype)
+    for idx, (otype, _) in enumerate(OPTION_TYPE_RULES))
+
+OPTION_TYPES = {
+    '<string>': 'string_nstring',
+    '<number>': 'number_nnumber',
+}
+
+SECTION_RE = re.compile(r'^  [A-Z]*$')
+
+
+def option_type(line, type_name):
+    if type_name == '<string>':
+        match = OPTION_TYPE_RE.match(line)
+        if match is not None:
+            return OPTION_RULE_TYPES[match.lastgroup]
+    return OPTION_TYPES.get(type_name, 'bool')
+
 
 def option_from_line(line):
     option = {'required': False, 'argv': False}
@@ -276,174 +368,1083 @@ def option_from_line(line):
     if name.startswith('--'):
         name = name[2:]
 
-    if type_name == '<string>':
-        if (re.search('domain name', line)
-            or re.search('list of domain', line))\
-                and not re.search('new', line):
-            type_name = 'string_domname'
-        elif re.search('domain', line) and re.search('uuid', line):
-            type_name = 'string_nstring'
-        elif re.search('pool name', line):
-            type_name = 'string_poolname'
-        elif re.search('volume name', line) or re.search('vol name', line):
-            type_name = 'string_volname'
-        elif re.search('network', line) and re.search('name', line):
-            type_name = 'string_netname'
-        elif re.search('network', line) and re.search('uuid', line):
-            type_name = 'string_nstring'
-        elif re.search('save', line):
-            type_name = 'string_nstring'
-        elif re.search('xml', line) or re.search('XML', line):
-            type_name = 'string_nstring'
-        elif re.search('command', line):
-            type_name = 'string_nstring'
-        elif re.search('interface', line):
-            type_name = 'string_nstring'
-        elif re.search('virttype', line):
-            type_name = 'string_nstring'
-        elif re.search('machine type', line):
-            type_name = 'string_nstring'
-        elif re.search('arch', line):
-            type_name = 'string_nstring'
-        elif re.search('emulator', line):
-            type_name = 'string_nstring'
-        elif re.search('new name', line) or re.search('clone name', line):
-            type_name = 'string_nstring'
-        elif re.search('secret UUID', line):
-            type_name = 'string_nstring'
-        elif re.search('MAC', line):
-            type_name = 'string_nstring'
-        else:
-            type_name = 'string_nstring'
-    elif type_name == '<number>':
-        type_name = 'number_nnumber'
-    else:
-        type_name = 'bool'
-    option['type'] = type_name
-
+    option['type'] = option_type(line, type_name)
     return name, option
 
 
-def command_from_help(name):
-    def _parse_options(opt_lines, synopsis):
-        options = {}
-        last_name = ''
-        for line in opt_lines:
-            opt_name, opt = option_from_line(line)
-            if re.match('string', opt['type']) and opt['required']:
-                if ('[<--%s>]' % opt_name in synopsis) or \
-                        ('[[--%s] <string>]' % opt_name in synopsis) or \
-                        ('[[--%s] <number>]' % opt_name in synopsis):
-                    opt['required'] = False
-            if re.search('domname', opt['type']):
-                f = open('/home/junli/haha', 'a')
-                print >>f, name
-                f.close()
-            options[opt_name] = opt
-            last_name = opt_name
-
-        if '...' in synopsis:
-            options[last_name]['argv'] = True
-        return options
-
-    help_contents = {}
-    help_txt = subprocess.check_output(
-        ['virsh', 'help', name]).splitlines()
-
-    item_name = ''
-    item_content = []
-    for line in help_txt:
-        if re.match(r'^  [A-Z]*$', line):
-            if item_name:
-                if item_name == 'options':
-                    help_contents[item_name] = item_content
-                else:
-                    help_contents[item_name] = ''.join(item_content)
-                item_content = []
-            item_name = line.strip().lower()
-        else:
-            if line:
-                item_content.append(line.strip())
-    if item_name:
-        if item_name == 'options':
-            help_contents[item_name] = item_content
-        else:
-            help_contents[item_name] = ''.join(item_content)
-        item_content = []
+class HelpParser(object):
+    # Single pass over ``virsh help <cmd>`` output: sections are tracked as
+    # lines go by, options are parsed as soon as they are read and the raw
+    # text is hashed on the way through.
+    def __init__(self, name):
+        self.name = name
+        self.digest = hashlib.sha1()
+        self.section = ''
+        self.synopsis = []
+        self.options = {}
+        self.last_name = ''
+
+    def feed(self, line):
+        self.digest.update(line.encode('utf-8'))
+        line = line.rstrip('\n')
+        if SECTION_RE.match(line):
+            self.section = line.strip().lower()
+            return
+        line = line.strip()
+        if not line:
+            return
+        if self.section == 'synopsis':
+            self.synopsis.append(line)
+        elif self.section == 'options':
+            self._option(line)
+
+    def _option(self, line):
+        opt_name, opt = option_from_line(line)
+        if opt['required'] and opt['type'].startswith('string'):
+            synopsis = ''.join(self.synopsis)
+            if ('[<--%s>]' % opt_name in synopsis) or \
+                    ('[[--%s] <string>]' % opt_name in synopsis) or \
+                    ('[[--%s] <number>]' % opt_name in synopsis):
+                opt['required'] = False
+        self.options[opt_name] = opt
+        self.last_name = opt_name
+
+    def close(self):
+        if self.options and '...' in ''.join(self.synopsis):
+            self.options[self.last_name]['argv'] = True
+        cmd = {
+            'options': self.options,
+            'exclusives': EXCLUSIVE_OPTIONS.get(self.name, []),
+        }
+        return cmd, self.digest.hexdigest()
+
+
+def parse_help(name, lines):
+    parser = HelpParser(name)
+    for line in lines:
+        parser.feed(line)
+    return parser.close()
+
+
+def virsh_lines(args):
+    # Yield virsh output as it is produced instead of buffering it whole.
+    argv = ['virsh'] + list(args)
+    proc = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                            universal_newlines=True)
+    try:
+        for line in iter(proc.stdout.readline, ''):
+            yield line
+    finally:
+        proc.stdout.close()
+        status = proc.wait()
+    if status:
+        raise subprocess.CalledProcessError(status, argv)
 
-    cmd = {'options': {}, 'exclusives': {}}
-    if 'options' in help_contents:
-        cmd['options'] = _parse_options(
-            help_contents['options'],
-            help_contents['synopsis'])
 
-    if name in EXCLUSIVE_OPTIONS:
-        cmd['exclusives'] = EXCLUSIVE_OPTIONS[name]
-    return cmd
 
 
-def cmd_names_from_help():
+def help_lines(name):
+    # Help output only needs stdout, so it can come from a pooled virsh
+    # shell when sessions are enabled.
+    if 'dice-virsh_utils.session' in sys.modules:
+        session_mod = sys.modules['dice-virsh_utils.session']
+        if session_mod.enabled():
+            result = session_mod.run('help %s' % name)
+            if result.completed and not result.stderr:
+                return result.stdout.splitlines(True)
+    return virsh_lines(['help', name])
+
+
+def help_text(name):
+    return ''.join(help_lines(name))
+
+
+def help_command(name):
+    return parse_help(name, help_lines(name))
+
+
+def command_from_help(name):
+    return help_command(name)[0]
+
+
+def cmd_names_from_lines(lines):
     names = []
-    for line in subprocess.check_output(['virsh', 'help']).splitlines():
+    for line in lines:
         if line.startswith('    '):
             name = line.split()[0]
             names.append(name)
     return names
 
 
-def load_cmds_from_path(path):
+def cmd_names_from_help():
+    return cmd_names_from_lines(virsh_lines(['help']))
+
+
+def virsh_binary():
+    for dirname in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        candidate = os.path.join(dirname, 'virsh')
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+def virsh_fingerprint(with_version=True):
+    binary = virsh_binary()
+    fingerprint = {
+        'binary': binary,
+        'mtime': os.path.getmtime(binary) if binary else None,
+        'version': None,
+    }
+    if with_version:
+        fingerprint['version'] = subprocess.check_output(
+            ['virsh', '--version'], universal_newlines=True).strip()
+    return fingerprint
+
+
+def load_catalog_from_path(path):
     with open(path, 'r') as fp:
-        cmds = json.load(fp)
-        return cmds
+        catalog = json.load(fp)
+    if catalog.get('schema') != CATALOG_SCHEMA:
+        raise ValueError('Unsupported virsh catalog schema in %s' % path)
+    return catalog
+
+
+def load_cmds_from_path(path):
+    return load_catalog_from_path(path)['commands']
 
 
-def load_cmds_from_help(path=None):
-    cmds = {}
-    for cmd_name in cmd_names_from_help():
-        cmds[cmd_name] = command_from_help(cmd_name)
+def save_catalog_to_path(catalog, path):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as fp:
+            json.dump(catalog, fp)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        logging.error('Failed to save virsh commands info to %s', path)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _map_help(function, names, workers):
+    if workers is None:
+        workers = HELP_WORKERS
+    if workers > 1 and len(names) > 1:
+        pool = ThreadPool(min(workers, len(names)))
+        try:
+            return pool.map(function, names)
+        finally:
+            pool.close()
+            pool.join()
+    return [function(name) for name in names]
+
+
+def _batch_help(names):
+    texts = virsh_batch(['help %s' % name for name in names])
+    # A command whose output went missing is fetched on its own.
+    return [text or help_text(name) for name, text in zip(names, texts)]
+
+
+def help_texts(names, workers=None):
+    # Every help text, fetched by at most ``workers`` batched virsh
+    # processes rather than one process per command.
+    if workers is None:
+        workers = HELP_WORKERS
+    if not names:
+        return []
+    size = -(-len(names) // max(workers, 1))
+    chunks = [names[idx:idx + size] for idx in range(0, len(names), size)]
+    texts = []
+    for chunk_texts in _map_help(_batch_help, chunks, workers):
+        texts.extend(chunk_texts)
+    return texts
+
+
+def build_catalog(workers=None, previous=None):
+    fingerprint = virsh_fingerprint()
+    names = cmd_names_from_help()
+    parsed = [parse_help(name, text.splitlines(True))
+              for name, text in zip(names, help_texts(names, workers))]
+    return assemble_catalog(fingerprint, names, parsed, previous=previous)
+
+
+def assemble_catalog(fingerprint, names, parsed, previous=None):
+    old_cmds, old_hashes = {}, {}
+    if previous is not None:
+        old_cmds = previous['commands']
+        old_hashes = previous['hashes']
+
+    cmds, hashes = {}, {}
+    changed = 0
+    for name, (cmd, digest) in zip(names, parsed):
+        hashes[name] = digest
+        if old_hashes.get(name) == digest and name in old_cmds:
+            cmds[name] = old_cmds[name]
+        else:
+            cmds[name] = cmd
+            changed += 1
+    if previous is not None:
+        logging.info('Refreshed virsh catalog for %s: %d of %d commands '
+                     'changed', fingerprint['version'], changed, len(names))
+
+    return {
+        'schema': CATALOG_SCHEMA,
+        'libvirt': fingerprint,
+        'hashes': hashes,
+        'commands': cmds,
+        'argtype_rules': ARGTYPE_RULES,
+        'argtypes': argtype_table(cmds),
+    }
+
+
+def refresh_catalog(catalog, path=None, workers=None):
+    changed = False
+    if catalog.get('argtype_rules') != ARGTYPE_RULES:
+        catalog['argtype_rules'] = ARGTYPE_RULES
+        catalog['argtypes'] = argtype_table(catalog['commands'])
+        changed = True
+
+    stored = catalog['libvirt']
+    fingerprint = virsh_fingerprint(with_version=False)
+    if (fingerprint['binary'] != stored['binary'] or
+            fingerprint['mtime'] != stored['mtime']):
+        try:
+            fingerprint = virsh_fingerprint()
+            if fingerprint['version'] == stored['version']:
+                catalog['libvirt'] = fingerprint
+            else:
+                catalog = build_catalog(workers=workers, previous=catalog)
+            changed = True
+        except (OSError, subprocess.CalledProcessError) as detail:
+            # Without a working virsh the stored catalog is the best guess.
+            logging.warning('Failed to refresh virsh catalog, keeping the '
+                            'stored one: %s', detail)
+    if changed and path:
+        save_catalog_to_path(catalog, path)
+    return catalog
+
+
+def load_cmds_from_help(path=None, workers=None):
+    catalog = build_catalog(workers=workers)
+    if path:
+        save_catalog_to_path(catalog, path)
+    return catalog['commands']
+
+
+def _open_archive(path, mode, compressed=None):
+    if compressed is None:
+        compressed = path.endswith('.gz')
+    if compressed:
+        return gzip.open(path, mode + 't')
+    return open(path, mode)
+
+
+def export_help_archive(path, workers=None):
+    # One file holding every help text of the local virsh, in the layout
+    # import_help_archive() reads back.
+    listing = ''.join(virsh_lines(['help']))
+    names = cmd_names_from_lines(listing.splitlines(True))
+    texts = help_texts(names, workers)
+    archive = {
+        'version': virsh_fingerprint()['version'],
+        'help': listing,
+        'commands': dict(zip(names, texts)),
+    }
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with _open_archive(tmp_path, 'w', path.endswith('.gz')) as fp:
+        json.dump(archive, fp, indent=1, sort_keys=True)
+    os.rename(tmp_path, path)
+    return archive
+
+
+def load_help_archive(path):
+    with _open_archive(path, 'r') as fp:
+        archive = json.load(fp)
+    for key in ('version', 'help', 'commands'):
+        if key not in archive:
+            raise ValueError('Invalid virsh help archive %s: missing %s' %
+                             (path, key))
+    return archive
+
+
+def catalog_from_archive(archive, previous=None):
+    # No virsh is run here. The fingerprint carries only the version, so a
+    # host with a matching virsh adopts the catalog after one --version.
+    fingerprint = {
+        'binary': None,
+        'mtime': None,
+        'version': archive['version'],
+    }
+    names = [name for name in cmd_names_from_lines(
+        archive['help'].splitlines(True)) if name in archive['commands']]
+    parsed = [parse_help(name, archive['commands'][name].splitlines(True))
+              for name in names]
+    return assemble_catalog(fingerprint, names, parsed, previous=previous)
+
+
+def import_help_archive(archive_path, path=None):
+    catalog = catalog_from_archive(load_help_archive(archive_path))
     if path:
+        save_catalog_to_path(catalog, path)
+    return catalog['commands']
+
+
+OPTIONS_VALID = 'valid'
+
+OPTIONS_UNKNOWN = 'unknown'
+
+OPTIONS_EXCLUSIVE = 'exclusive'
+
+OPTIONS_MISSING = 'missing'
+
+
+class OptionIndex(object):
+    # Gives every option of a command one bit, so an option list becomes a
+    # mask and each constraint check is a bitwise test against it.
+    def __init__(self, options, required, exclusives):
+        self.names = sorted(options)
+        self.bits = dict((name, 1 << idx)
+                         for idx, name in enumerate(self.names))
+        self.required = self.mask(required)[0]
+        self.pairs = tuple(self.bits[first] | self.bits[second]
+                           for first, second in exclusives
+                           if first in self.bits and second in self.bits)
+
+    def mask(self, options):
+        mask = 0
+        unknown = False
+        for opt in options:
+            bit = self.bits.get(opt)
+            if bit is None:
+                unknown = True
+            else:
+                mask |= bit
+        return mask, unknown
+
+    def classify_mask(self, mask):
+        for pair in self.pairs:
+            if mask & pair == pair:
+                return OPTIONS_EXCLUSIVE
+        if mask & self.required != self.required:
+            return OPTIONS_MISSING
+        return OPTIONS_VALID
+
+    def classify(self, options):
+        mask, unknown = self.mask(options)
+        if unknown:
+            return OPTIONS_UNKNOWN
+        return self.classify_mask(mask)
+
+    def names_of(self, mask):
+        return [name for idx, name in enumerate(self.names)
+                if mask >> idx & 1]
+
+    def space(self):
+        if getattr(self, '_space', None) is None:
+            self._space = OptionSpace(self)
+        return self._space
+
+
+class OptionSpace(object):
+    # The valid option sets of one command. Options linked by exclusive
+    # pairs form components whose valid subsets are enumerated once; every
+    # other option is free. Components and free options are independent,
+    # so picking each uniformly picks a valid set uniformly. The space is
+    # also a sequence, so the Options oracle's 'options in
+    # virsh.option_space(subcmd)' lets DICE draw valid lists straight from
+    # it instead of rejecting random ones.
+    def __init__(self, index):
+        self.index = index
+        neighbours = dict((bit, 0) for bit in index.bits.values())
+        forbidden = 0
+        for pair in index.pairs:
+            first = pair & -pair
+            second = pair ^ first
+            if not second:
+                # An option exclusive with itself can never be given.
+                forbidden |= first
+                continue
+            neighbours[first] |= second
+            neighbours[second] |= first
+
+        self.base = 0
+        self.free = []
+        self.components = []
+        seen = 0
+        for bit in sorted(neighbours):
+            if bit & seen:
+                continue
+            component = self._component(bit, neighbours)
+            for member in component:
+                seen |= member
+            if len(component) == 1 and not neighbours[bit]:
+                if bit & forbidden:
+                    if bit & index.required:
+                        self.components.append([])
+                elif bit & index.required:
+                    self.base |= bit
+                else:
+                    self.free.append(bit)
+                continue
+            self.components.append(
+                self._valid_subsets(component, neighbours, forbidden))
+
+    @staticmethod
+    def _component(bit, neighbours):
+        component = []
+        todo = [bit]
+        seen = bit
+        while todo:
+            member = todo.pop()
+            component.append(member)
+            rest = neighbours[member] & ~seen
+            while rest:
+                other = rest & -rest
+                rest ^= other
+                seen |= other
+                todo.append(other)
+        return sorted(component)
+
+    def _valid_subsets(self, component, neighbours, forbidden):
+        required = self.index.required
+        subsets = []
+
+        def _walk(idx, mask, blocked):
+            if idx == len(component):
+                subsets.append(mask)
+                return
+            bit = component[idx]
+            if not bit & required:
+                _walk(idx + 1, mask, blocked)
+            if not bit & (blocked | forbidden):
+                _walk(idx + 1, mask | bit, blocked | neighbours[bit])
+
+        _walk(0, 0, 0)
+        return subsets
+
+    def count(self):
+        total = 2 ** len(self.free)
+        for subsets in self.components:
+            total *= len(subsets)
+        return total
+
+    def sample(self, rng=random):
+        if not self.count():
+            raise ValueError('No valid option set for %s' %
+                             ' '.join(self.index.names))
+        mask = self.base
+        for subsets in self.components:
+            mask |= rng.choice(subsets)
+        if self.free:
+            picks = rng.getrandbits(len(self.free))
+            for idx, bit in enumerate(self.free):
+                if picks >> idx & 1:
+                    mask |= bit
+        return self.index.names_of(mask)
+
+    def __contains__(self, options):
+        return self.index.classify(options) == OPTIONS_VALID
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, idx):
+        # The idx-th set in iteration order, without enumerating the others.
+        total = self.count()
+        if idx < 0:
+            idx += total
+        if not 0 <= idx < total:
+            raise IndexError('option set index out of range')
+        idx, picks = divmod(idx, 2 ** len(self.free))
+        mask = self.base
+        for subsets in reversed(self.components):
+            idx, pos = divmod(idx, len(subsets))
+            mask |= subsets[pos]
+        for pos, bit in enumerate(self.free):
+            if picks >> pos & 1:
+                mask |= bit
+        return self.index.names_of(mask)
+
+    def __iter__(self):
+        for chosen in itertools.product(*self.components):
+            mask = self.base
+            for subset in chosen:
+                mask |= subset
+            for picks in range(2 ** len(self.free)):
+                free_mask = 0
+                for idx, bit in enumerate(self.free):
+                    if picks >> idx & 1:
+                        free_mask |= bit
+                yield self.index.names_of(mask | free_mask)
+
+
+class CommandView(object):
+    def __init__(self, name, cmd):
+        self.name = name
+        self.cmd = cmd
+        self.options = frozenset(cmd['options'])
+        self.required = tuple(
+            opt for opt, info in cmd['options'].items() if info['required'])
+        self.exclusives = tuple(tuple(pair) for pair in cmd['exclusives'])
+        self._index = None
+
+    def index(self):
+        if self._index is None:
+            self._index = OptionIndex(self.options, self.required,
+                                      self.exclusives)
+        return self._index
+
+
+class CommandCatalog(object):
+    # Decoded once per process, reloaded when the file's mtime/size changes.
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._stamp = None
+        self._cmds = None
+        self._catalog = None
+        self._views = {}
+        self._argtypes = {}
+
+    def _stat(self):
         try:
-            with open(path, 'w') as fp:
-                json.dump(cmds, fp)
-        except IOError:
-            logging.error('Failed to save virsh commands info to %s', path)
-    return cmds
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    def _load(self, stamp):
+        catalog = None
+        if stamp is not None:
+            try:
+                catalog = load_catalog_from_path(self.path)
+            except (IOError, ValueError, KeyError):
+                logging.warning('Failed to load virsh commands from %s',
+                                self.path)
+        if catalog is None and HELP_ARCHIVE:
+            try:
+                catalog = catalog_from_archive(load_help_archive(HELP_ARCHIVE))
+            except (IOError, ValueError, KeyError):
+                logging.warning('Failed to import virsh help archive %s',
+                                HELP_ARCHIVE)
+            else:
+                catalog = refresh_catalog(catalog)
+                save_catalog_to_path(catalog, self.path)
+        if catalog is None:
+            catalog = build_catalog()
+            save_catalog_to_path(catalog, self.path)
+        else:
+            catalog = refresh_catalog(catalog, path=self.path)
+        cmds = catalog['commands']
+        self._views = dict((name, CommandView(name, cmd))
+                           for name, cmd in cmds.items())
+        self._argtypes = dict(
+            ((name, opt), otype)
+            for name, otypes in catalog['argtypes'].items()
+            for opt, otype in otypes.items())
+        self._cmds = cmds
+        self._catalog = catalog
+        self._stamp = self._stat()
+        if CATALOG_FORMAT == 'mmap':
+            self.save_binary(self.path + BINARY_SUFFIX)
+
+    def commands(self):
+        stamp = self._stat()
+        if self._cmds is None or stamp != self._stamp:
+            with self._lock:
+                if self._cmds is None or stamp != self._stamp:
+                    self._load(stamp)
+        return self._cmds
+
+    def view(self, command):
+        self.commands()
+        return self._views[command]
+
+    def argtypes(self):
+        self.commands()
+        return self._argtypes
+
+    def save_binary(self, path):
+        # Mirrors the catalog decoded here; it is only loaded when this
+        # process has not done so yet.
+        with self._lock:
+            self.commands()
+            if binary_catalog_stamp(path) != self._stamp:
+                save_binary_catalog(self._catalog, path, self._stamp)
+
+    def invalidate(self):
+        with self._lock:
+            self._cmds = None
+            self._catalog = None
+            self._views = {}
+            self._argtypes = {}
+
+
+_CATALOGS = {}
+
+
+def catalog():
+    path = os.path.join(data_dir.USER_BASE_DIR, 'virsh')
+    if path not in _CATALOGS:
+        _CATALOGS.setdefault(path, CommandCatalog(path))
+    return _CATALOGS[path]
+
+
+# Binary catalog: a header, an offset table into a UTF-8 blob of interned
+# strings, then fixed-width command, option and exclusive-pair records.
+# Commands are sorted by name and own a contiguous run of options (also
+# sorted by name) and of pairs, so lookups are binary searches over the
+# mapping. The header carries the stamp of the JSON catalog it mirrors.
+BINARY_SUFFIX = '.bin'
+
+BINARY_MAGIC = b'DVCB'
+
+BINARY_SCHEMA = 1
+
+BINARY_HEADER = struct.Struct('<4sHxxdQ9I')
+
+BINARY_COMMAND = struct.Struct('<IIIII')
+
+BINARY_OPTION = struct.Struct('<IIIB3x')
+
+BINARY_PAIR = struct.Struct('<II')
+
+BINARY_OFFSET = struct.Struct('<II')
+
+BINARY_NO_STRING = 0xFFFFFFFF
+
+OPTION_REQUIRED = 1
+
+OPTION_ARGV = 2
+
+
+def save_binary_catalog(catalog, path, stamp):
+    strings = {}
+    blob = []
+    offsets = [0]
+
+    def _sid(text):
+        if text is None:
+            return BINARY_NO_STRING
+        if text not in strings:
+            strings[text] = len(strings)
+            blob.append(text.encode('utf-8'))
+            offsets.append(offsets[-1] + len(blob[-1]))
+        return strings[text]
+
+    commands, options, pairs = [], [], []
+    for name in sorted(catalog['commands']):
+        cmd = catalog['commands'][name]
+        otypes = catalog['argtypes'].get(name, {})
+        commands.append((_sid(name), len(options), len(cmd['options']),
+                         len(pairs), len(cmd['exclusives'])))
+        for opt in sorted(cmd['options']):
+            info = cmd['options'][opt]
+            flags = ((OPTION_REQUIRED if info['required'] else 0) |
+                     (OPTION_ARGV if info['argv'] else 0))
+            options.append((_sid(opt), _sid(info['type']),
+                            _sid(otypes.get(opt)), flags))
+        for first, second in cmd['exclusives']:
+            pairs.append((_sid(first), _sid(second)))
+
+    offsets_at = BINARY_HEADER.size
+    commands_at = offsets_at + 4 * len(offsets)
+    options_at = commands_at + BINARY_COMMAND.size * len(commands)
+    pairs_at = options_at + BINARY_OPTION.size * len(options)
+    blob_at = pairs_at + BINARY_PAIR.size * len(pairs)
+    chunks = [BINARY_HEADER.pack(
+        BINARY_MAGIC, BINARY_SCHEMA, stamp[0], stamp[1], len(strings),
+        len(commands), len(options), len(pairs), offsets_at, commands_at,
+        options_at, pairs_at, blob_at)]
+    chunks.append(struct.pack('<%dI' % len(offsets), *offsets))
+    chunks.extend(BINARY_COMMAND.pack(*record) for record in commands)
+    chunks.extend(BINARY_OPTION.pack(*record) for record in options)
+    chunks.extend(BINARY_PAIR.pack(*record) for record in pairs)
+    chunks.extend(blob)
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as fp:
+            fp.write(b''.join(chunks))
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        logging.error('Failed to save binary virsh catalog to %s', path)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
-def load_commands():
-    path = os.path.join(data_dir.USER_BASE_DIR, 'virsh')
+def binary_catalog_stamp(path):
     try:
-        return load_cmds_from_path(path)
-    except IOError:
-        return load_cmds_from_help(path=path)
+        with open(path, 'rb') as fp:
+            header = BINARY_HEADER.unpack(fp.read(BINARY_HEADER.size))
+    except (IOError, OSError, struct.error):
+        return None
+    if header[0] != BINARY_MAGIC or header[1] != BINARY_SCHEMA:
+        return None
+    return header[2], header[3]
+
+
+class BinaryCatalog(object):
+    # Read-only view of a binary catalog through mmap; nothing is decoded
+    # up front, so processes mapping the same file share its pages.
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        header = BINARY_HEADER.unpack_from(self._map, 0)
+        if header[0] != BINARY_MAGIC or header[1] != BINARY_SCHEMA:
+            self._map.close()
+            raise ValueError('Unsupported binary virsh catalog %s' % path)
+        self.stamp = header[2], header[3]
+        self.views = {}
+        self._names = None
+        (_, self._n_commands, _, _, self._offsets_at, self._commands_at,
+         self._options_at, self._pairs_at, self._blob_at) = header[4:]
+
+    def close(self):
+        self._map.close()
+
+    def string(self, sid):
+        if sid == BINARY_NO_STRING:
+            return None
+        start, end = BINARY_OFFSET.unpack_from(
+            self._map, self._offsets_at + 4 * sid)
+        return self._map[self._blob_at + start:
+                         self._blob_at + end].decode('utf-8')
+
+    def _command(self, idx):
+        return BINARY_COMMAND.unpack_from(
+            self._map, self._commands_at + BINARY_COMMAND.size * idx)
+
+    def _option(self, idx):
+        return BINARY_OPTION.unpack_from(
+            self._map, self._options_at + BINARY_OPTION.size * idx)
+
+    def _pair(self, idx):
+        return BINARY_PAIR.unpack_from(
+            self._map, self._pairs_at + BINARY_PAIR.size * idx)
+
+    def _search(self, record, lo, hi, name):
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key = self.string(record(mid)[0])
+            if key == name:
+                return mid
+            elif key < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def command(self, name):
+        idx = self._search(self._command, 0, self._n_commands, name)
+        if idx is None:
+            raise KeyError(name)
+        return self._command(idx)
+
+    def names(self):
+        if self._names is None:
+            self._names = [self.string(self._command(idx)[0])
+                           for idx in range(self._n_commands)]
+        return self._names
+
+    def options(self, name):
+        _, start, count, _, _ = self.command(name)
+        return [self._option(idx) for idx in range(start, start + count)]
+
+    def pairs(self, name):
+        _, _, _, start, count = self.command(name)
+        return [self._pair(idx) for idx in range(start, start + count)]
+
+    def argtype(self, name, option):
+        # None for an option whose type could not be resolved.
+        _, start, count, _, _ = self.command(name)
+        idx = self._search(self._option, start, start + count, option)
+        if idx is None:
+            raise KeyError(option)
+        return self.string(self._option(idx)[2])
+
+    def view(self, name):
+        # Cached per mapping, so a remapped catalog gets fresh views.
+        if name not in self.views:
+            self.views.setdefault(name, MappedView(self, name))
+        return self.views[name]
+
+
+class MappedView(object):
+    # Same attributes as CommandView, decoded from the mapping for just
+    # this command.
+    def __init__(self, mapped, name):
+        self.name = name
+        records = mapped.options(name)
+        self.options = frozenset(mapped.string(record[0])
+                                 for record in records)
+        self.required = tuple(mapped.string(record[0]) for record in records
+                              if record[3] & OPTION_REQUIRED)
+        self.exclusives = tuple(
+            (mapped.string(first), mapped.string(second))
+            for first, second in mapped.pairs(name))
+        self._index = None
+
+    def index(self):
+        if self._index is None:
+            self._index = OptionIndex(self.options, self.required,
+                                      self.exclusives)
+        return self._index
+
+
+class MappedCatalog(object):
+    # Serves lookups from the binary sibling of a JSON catalog. A stale or
+    # missing binary file is rewritten by loading the JSON catalog once.
+    def __init__(self, path):
+        self.path = path
+        self.bin_path = path + BINARY_SUFFIX
+        self._lock = threading.Lock()
+        self._mapped = None
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    def _map_fresh(self, stamp):
+        if stamp is not None and binary_catalog_stamp(self.bin_path) == stamp:
+            try:
+                return BinaryCatalog(self.bin_path)
+            except (IOError, OSError, ValueError, struct.error):
+                pass
+        return None
+
+    def _open(self, stamp):
+        mapped = self._map_fresh(stamp)
+        if mapped is not None:
+            return mapped
+        # One process rewrites a stale binary file; the others wait for it
+        # and map the result instead of decoding the JSON catalog as well.
+        with open(self.bin_path + '.lock', 'a') as lock_fp:
+            fcntl.flock(lock_fp.fileno(), fcntl.LOCK_EX)
+            try:
+                mapped = self._map_fresh(self._stat())
+                if mapped is not None:
+                    return mapped
+                catalog().save_binary(self.bin_path)
+            finally:
+                fcntl.flock(lock_fp.fileno(), fcntl.LOCK_UN)
+        try:
+            return BinaryCatalog(self.bin_path)
+        except (IOError, OSError, ValueError, struct.error):
+            logging.warning('Failed to map binary virsh catalog %s',
+                            self.bin_path)
+            return None
 
+    def mapping(self):
+        stamp = self._stat()
+        mapped = self._mapped
+        if mapped is None or mapped.stamp != stamp:
+            with self._lock:
+                if self._mapped is None or self._mapped.stamp != stamp:
+                    self._mapped = self._open(stamp)
+                mapped = self._mapped
+        return mapped
 
-def commands(excludes=[]):
-    excludes += ['qemu-monitor-event', 'pool-delete']
-    cmds = load_commands().keys()
-    if len(excludes) == 0:
-        return cmds
-    else:
-        return list(set(load_commands().keys()) - set(excludes))
 
+_MAPPED_CATALOGS = {}
+
+
+def mapped_catalog():
+    path = os.path.join(data_dir.USER_BASE_DIR, 'virsh')
+    if path not in _MAPPED_CATALOGS:
+        _MAPPED_CATALOGS.setdefault(path, MappedCatalog(path))
+    return _MAPPED_CATALOGS[path]
 
+
+def command_view(command):
+    if CATALOG_FORMAT == 'mmap':
+        mapped = mapped_catalog().mapping()
+        if mapped is not None:
+            return mapped.view(command)
+    return catalog().view(command)
+
+
+def load_commands():
+    return catalog().commands()
+
+
+def command_names():
+    if CATALOG_FORMAT == 'mmap':
+        mapped = mapped_catalog().mapping()
+        if mapped is not None:
+            return mapped.names()
+    return list(load_commands())
+
+
+def commands(excludes=()):
+    excludes = list(excludes) + ['qemu-monitor-event', 'pool-delete']
+    return list(set(command_names()) - set(excludes))
+
+
+# The oracles get plain lists, as they always have; the views keep the
+# frozen forms for the option index.
 def options(command):
-    cmd = load_commands()[command]
-    return cmd['options'].keys()
+    return list(command_view(command).options)
 
 
 def exclusive_options(command):
-    cmd = load_commands()[command]
-    return cmd['exclusives']
+    return [list(pair) for pair in command_view(command).exclusives]
 
 
 def required_options(command):
-    cmd = load_commands()[command]
-    req_options = []
-    for opt in cmd['options'].keys():
-        if cmd['options'][opt]['required'] is True:
-            req_options.append(opt)
-    return req_options
+    return list(command_view(command).required)
+
+
+def option_index(command):
+    return command_view(command).index()
+
+
+def classify_options(command, options):
+    # One of OPTIONS_VALID, OPTIONS_UNKNOWN, OPTIONS_EXCLUSIVE or
+    # OPTIONS_MISSING, checked in the order the Options oracle used to.
+    return option_index(command).classify(options)
+
+
+def option_space(command):
+    return option_index(command).space()
+
+
+def sample_options(command, rng=random):
+    # A valid option list drawn uniformly from all valid ones.
+    return option_space(command).sample(rng)
+
+
+def iter_options(command):
+    return iter(option_space(command))
+
+
+def count_options(command):
+    return option_space(command).count()
+
+
+def option_space_sizes(cmds=None):
+    if cmds is None:
+        cmds = commands()
+    return dict((command, count_options(command)) for command in cmds)
+
+
+INVENTORY_MARKER = 'dice-virsh-inventory'
+
+INVENTORY_MARKER_RE = re.compile(r'^%s (\d+)\n' % INVENTORY_MARKER, re.M)
+
+
+def virsh_batch(cmdlines):
+    # Run several virsh commands in one process. Each one is followed by an
+    # echo of the marker and its index; the marker must not start with a
+    # dash, or virsh's echo takes it for an option and prints nothing.
+    script = ' ; '.join("%s ; echo '%s' '%d'" % (cmdline, INVENTORY_MARKER, idx)
+                        for idx, cmdline in enumerate(cmdlines))
+    proc = subprocess.Popen(['virsh', script], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    out, err = proc.communicate()
+    if err:
+        logging.debug('virsh batch %r reported: %s', script, err.strip())
+    outputs = [''] * len(cmdlines)
+    start = 0
+    for match in INVENTORY_MARKER_RE.finditer(out):
+        idx = int(match.group(1))
+        if idx < len(outputs):
+            outputs[idx] = out[start:match.start()]
+        start = match.end()
+    return outputs
+
+
+def _table_rows(output, maxsplit):
+    rows = []
+    in_body = False
+    for line in output.splitlines():
+        line = line.strip()
+        if not in_body:
+            in_body = line.startswith('---')
+            continue
+        if line:
+            rows.append(line.split(None, maxsplit))
+    return rows
+
+
+def _vol_paths(output):
+    vollist = []
+    for row in _table_rows(output, 1):
+        if row[0] == 'lost+found' or len(row) < 2:
+            continue
+        vollist.append(row[1])
+    return vollist
+
+
+class Inventory(object):
+    # Short-lived snapshot of domains, pools, networks and volumes.
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._snapshot = None
+        self._taken = 0
+
+    def _collect(self):
+        dom_out, pool_out, net_out = virsh_batch(
+            ['list --all', 'pool-list --all', 'net-list --all'])
+        snapshot = {
+            'dom': [(row[1], row[2]) for row in _table_rows(dom_out, 2)
+                    if len(row) == 3],
+            'pool': [(row[0], row[1]) for row in _table_rows(pool_out, 2)
+                     if len(row) >= 2],
+            'net': [(row[0], row[1]) for row in _table_rows(net_out, 2)
+                    if len(row) >= 2],
+            'vol': {},
+        }
+
+        act_pools = [pool for pool, state in snapshot['pool']
+                     if state == 'active']
+        if act_pools:
+            vol_outs = virsh_batch(['vol-list --pool %s' % pool
+                                    for pool in act_pools])
+            for pool, vol_out in zip(act_pools, vol_outs):
+                snapshot['vol'][pool] = _vol_paths(vol_out)
+        return snapshot
+
+    def snapshot(self):
+        with self._lock:
+            now = time.time()
+            if self._snapshot is None or now - self._taken > self.ttl:
+                self._snapshot = self._collect()
+                self._taken = now
+            return self._snapshot
+
+    def names(self, kind, states=None):
+        return [name for name, state in self.snapshot()[kind]
+                if states is None or state in states]
+
+    def volumes(self, pool):
+        vols = self.snapshot()['vol']
+        if pool not in vols:
+            vols[pool] = _vol_paths(subprocess.check_output(
+                ['virsh', 'vol-list', '--pool', str(pool)],
+                universal_newlines=True))
+        return vols[pool]
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+
+
+INVENTORY = Inventory(INVENTORY_TTL)
+
+
+def invalidate_inventory(command=None):
+    if command is None or command in INVENTORY_COMMANDS:
+        INVENTORY.invalidate()
+    if command in INVENTORY_COMMANDS:
+        sys.modules['dice-virsh_utils.fixtures'].poke()
+
+
+def changes_state(command):
+    return command in STATE_COMMANDS
 
 
 #  args generate
@@ -463,90 +1464,53 @@ def number_nnumber():
     return list(nnumberlist)
 
 
+def _fixtures():
+    return sys.modules['dice-virsh_utils.fixtures'].manager()
+
+
+def _ready(kind, wanted):
+    # Fixtures in the wanted state are used as they are; the reconciler only
+    # steps in when none are ready yet.
+    return (_fixtures().take(kind, wanted) or
+            RECONCILER.ensure(kind, wanted))
+
+
 def define_dom():
-    xmllist = []
-    assert len(xmllist) > 0
-    for xml in xmllist:
-        subprocess.call(['virsh', 'define', xml])
+    return _fixtures().define('dom')
+
+
+DOMAIN_STATES = {
+    None: None,
+    'running': ['running'],
+    'paused': ['paused'],
+    'shutoff': ['shut off'],
+    'rop': ['running', 'paused'],
+}
 
 
 def string_domname(state=None):
-    if state is None:
-        alldom = subprocess.check_output(
-            ['virsh', 'list', '--all', '--name']).splitlines()
-    elif state == 'running':
-        alldom = subprocess.check_output(
-            ['virsh', 'list', '--state-running', '--name']).splitlines()
-    elif state == 'paused':
-        alldom = subprocess.check_output(
-            ['virsh', 'list', '--state-paused', '--name']).splitlines()
-    elif state == 'shutoff':
-        alldom = subprocess.check_output(
-            ['virsh', 'list', '--state-shutoff', '--name']).splitlines()
-    elif state == 'rop':
-        alldom = subprocess.check_output(
-            ['virsh', 'list', '--state-running', '--state-paused',
-             '--name']).splitlines()
-
-    domlist = []
-    for line in alldom:
-        dmn = line.strip()
-        dmn = dmn.decode('utf-8')
-        if dmn:
-            domlist.append(dmn)
+    domlist = INVENTORY.names('dom', DOMAIN_STATES[state])
     if len(domlist) == 0 and state is None:
         define_dom()
-        domlist = string_domname()
+        invalidate_inventory()
+        domlist = INVENTORY.names('dom')
     return domlist
 
 
-def destroy_dom():
-    domlist = string_domname()
-    for dom in domlist:
-        subprocess.call(['virsh', 'destroy', str(dom)])
-
-
 def string_domname_shutoff():
-    domlist = string_domname('shutoff')
-    if len(domlist) == 0:
-        destroy_dom()
-        domlist = string_domname_shutoff()
-    return domlist
-
-
-def start_dom():
-    domlist = string_domname_shutoff()
-    for dom in domlist:
-        subprocess.call(['virsh', 'start', str(dom)])
+    return _ready('dom', 'shutoff')
 
 
 def string_domname_running():
-    domlist = string_domname('running')
-    if len(domlist) == 0:
-        start_dom()
-        domlist = string_domname_running()
-    return domlist
-
-
-def suspend_dom():
-    domlist = string_domname_running()
-    for dom in domlist:
-        subprocess.call(['virsh', 'suspend', str(dom)])
+    return _ready('dom', 'running')
 
 
 def string_domname_paused():
-    domlist = string_domname('paused')
-    if len(domlist) == 0:
-        suspend_dom()
-        domlist = string_domname_paused()
-    return domlist
+    return _ready('dom', 'paused')
 
 
 def string_domname_rop():
-    domlist = string_domname('rop')
-    if len(domlist) == 0:
-        domlist = string_domname_running()
-    return domlist
+    return _ready('dom', 'rop')
 
 
 def liststring_domname():
@@ -554,133 +1518,169 @@ def liststring_domname():
 
 
 def define_pool():
-    xmllist = []
-    assert len(xmllist) > 0
-    for xml in xmllist:
-        subprocess.call(['virsh', 'pool-define', xml])
+    return _fixtures().define('pool')
 
 
-def string_poolname(state=None):
-    if state is None:
-        allactpool = subprocess.check_output(
-            ['virsh', 'pool-list', '--all']).splitlines()
-    elif state == 'ina':
-        allactpool = subprocess.check_output(
-            ['virsh', 'pool-list', '--inactive']).splitlines()
-    elif state == 'act':
-        allactpool = subprocess.check_output(
-            ['virsh', 'pool-list']).splitlines()
-    del allactpool[1]
-    del allactpool[0]
+OBJECT_STATES = {
+    None: None,
+    'ina': ['inactive'],
+    'act': ['active'],
+}
 
-    poollist = []
-    for line in allactpool:
-        pool = line.strip()
-        pool = pool.decode('utf-8')
-        if pool:
-            i, _ = re.search(' +', pool).span()
-            pool = pool[:i]
-            poollist.append(pool)
 
+def string_poolname(state=None):
+    poollist = INVENTORY.names('pool', OBJECT_STATES[state])
     if len(poollist) == 0 and state is None:
         define_pool()
-        poollist = string_poolname()
-
-    return poollist
-
-
-def ina_pool():
-    poollist = string_poolname()
-    for pool in poollist:
-        subprocess.call(['virsh', 'pool-destroy', str(pool)])
+        invalidate_inventory()
+        poollist = INVENTORY.names('pool')
     return poollist
 
 
 def string_poolname_ina():
-    poollist = string_poolname('ina')
-    if len(poollist) == 0:
-        poollist = ina_pool()
-    return poollist
-
-
-def act_pool():
-    poollist = string_poolname_ina()
-    for pool in poollist:
-        subprocess.call(['virsh', 'pool-start', str(pool)])
-    return poollist
+    return _ready('pool', 'ina')
 
 
 def string_poolname_act():
-    poollist = string_poolname('act')
-    if len(poollist) == 0:
-        poollist = act_pool()
-    return poollist
+    return _ready('pool', 'act')
 
 
 def define_net():
-    xmllist = []
-    assert len(xmllist) > 0
-    for xml in xmllist:
-        subprocess.call(['virsh', 'net-define', xml])
+    return _fixtures().define('net')
 
 
 def string_netname(state=None):
-    if state is None:
-        allactnet = subprocess.check_output(
-            ['virsh', 'net-list', '--all']).splitlines()
-    elif state == 'ina':
-        allactnet = subprocess.check_output(
-            ['virsh', 'net-list', '--inactive']).splitlines()
-    elif state == 'act':
-        allactnet = subprocess.check_output(
-            ['virsh', 'net-list']).splitlines()
-    del allactnet[1]
-    del allactnet[0]
-
-    netlist = []
-    for line in allactnet:
-        net = line.strip()
-        net = net.decode('utf-8')
-        if net:
-            i, _ = re.search(' +', net).span()
-            net = net[:i]
-            netlist.append(net)
-
+    netlist = INVENTORY.names('net', OBJECT_STATES[state])
     if len(netlist) == 0 and state is None:
         define_net()
-        netlist = string_netname()
+        invalidate_inventory()
+        netlist = INVENTORY.names('net')
 
     if 'default' in netlist:
             netlist.remove('default')
     return netlist
 
 
-def ina_net():
-    netlist = string_netname()
-    for net in netlist:
-        subprocess.call(['virsh', 'net-destroy', str(net)])
-    return netlist
+def string_netname_ina():
+    return _ready('net', 'ina')
 
 
-def string_netname_ina():
-    netlist = string_netname('ina')
-    if len(netlist) == 0:
-        netlist = ina_net()
-    return netlist
+def string_netname_act():
+    return _ready('net', 'act')
 
 
-def act_net():
-    netlist = string_netname_ina()
-    for net in netlist:
-        subprocess.call(['virsh', 'net-start', str(net)])
-    return netlist
+# Transitions that bring an object into a wanted state, tried in order:
+# (kind, wanted) -> [(states it can be moved from, virsh command), ...].
+# Every wanted state is one transition away from any other state.
+RECONCILE_TRANSITIONS = {
+    ('dom', 'running'): [
+        (['paused'], ['resume']),
+        (['shut off'], ['start']),
+    ],
+    ('dom', 'paused'): [
+        (['running'], ['suspend']),
+        (['shut off'], ['start', '--paused']),
+    ],
+    ('dom', 'shutoff'): [
+        (['running', 'paused'], ['destroy']),
+    ],
+    ('dom', 'rop'): [
+        (['shut off'], ['start']),
+    ],
+    ('pool', 'ina'): [
+        (['active'], ['pool-destroy']),
+    ],
+    ('pool', 'act'): [
+        (['inactive'], ['pool-start']),
+    ],
+    ('net', 'ina'): [
+        (['active'], ['net-destroy']),
+    ],
+    ('net', 'act'): [
+        (['inactive'], ['net-start']),
+    ],
+}
 
+# Objects the reconciler never touches.
+RECONCILE_KEEP = {
+    'net': frozenset(['default']),
+}
 
-def string_netname_act():
-    netlist = string_netname('act')
-    if len(netlist) == 0:
-        netlist = act_net()
-    return netlist
+
+def _transition(argv):
+    proc = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    _, err = proc.communicate()
+    return argv, proc.returncode, err
+
+
+class Reconciler(object):
+    # Moves just enough objects into a wanted state, concurrently and within
+    # a fixed number of attempts, instead of forcing every object.
+    def __init__(self, count, retries, workers):
+        self.count = count
+        self.retries = retries
+        self.workers = workers
+        self._lock = threading.Lock()
+
+    def listing(self, kind, wanted):
+        if kind == 'dom':
+            return string_domname(wanted)
+        elif kind == 'pool':
+            return string_poolname(wanted)
+        return string_netname(wanted)
+
+    def candidates(self, kind, wanted, failed):
+        keep = RECONCILE_KEEP.get(kind, frozenset()) | failed
+        plan = []
+        for states, command in RECONCILE_TRANSITIONS[(kind, wanted)]:
+            for name in INVENTORY.names(kind, states):
+                if len(plan) >= self.count:
+                    return plan
+                if name not in keep:
+                    plan.append(['virsh'] + command + [str(name)])
+        return plan
+
+    def apply(self, plan):
+        if len(plan) == 1 or self.workers <= 1:
+            return [_transition(argv) for argv in plan]
+        pool = ThreadPool(min(self.workers, len(plan)))
+        try:
+            return pool.map(_transition, plan)
+        finally:
+            pool.close()
+            pool.join()
+
+    def ensure(self, kind, wanted):
+        names = self.listing(kind, wanted)
+        if names:
+            return names
+
+        # Serialized so concurrent callers do not race to move the same
+        # objects; the first one to finish satisfies the rest.
+        with self._lock:
+            failed = set()
+            for _ in range(self.retries):
+                names = self.listing(kind, wanted)
+                if names:
+                    return names
+                plan = self.candidates(kind, wanted, failed)
+                if not plan:
+                    break
+                for argv, status, err in self.apply(plan):
+                    if status != 0:
+                        logging.debug('%s failed: %s', ' '.join(argv),
+                                      err.strip())
+                        failed.add(argv[-1])
+                invalidate_inventory()
+            names = self.listing(kind, wanted)
+        if not names:
+            logging.warning('No %s could be brought to state %s', kind,
+                            wanted)
+        return names
+
+
+RECONCILER = Reconciler(RECONCILE_COUNT, RECONCILE_RETRIES, RECONCILE_WORKERS)
 
 
 def string_volname(pool=None):
@@ -692,19 +1692,7 @@ def string_volname(pool=None):
         poollist = string_poolname_act()
 
     for pl in poollist:
-        allvol = subprocess.check_output(
-            ['virsh', 'vol-list', '--pool', str(pl)]).splitlines()
-        if len(allvol) > 2 and re.search('lost+found', allvol[2]):
-            del allvol[2]
-        del allvol[1]
-        del allvol[0]
-        for line in allvol:
-            vol = line.strip()
-            vol = vol.decode('utf-8')
-            if vol:
-                _, i = re.search(r' +', vol).span()
-                vol = vol[i:]
-                vollist.append(vol)
+        vollist.extend(INVENTORY.volumes(pl))
     return vollist
 
 
@@ -724,18 +1712,18 @@ def string_xml_doumain_base():
 
 
 def cpu_list():
-    return re.findall('processor.+?:.+?(\d+)', open('/proc/cpuinfo', 'r').read())
+    host_mod = sys.modules['dice-virsh_utils.hostfacts']
+    return [str(cpu) for cpu in host_mod.cpus()]
 
 
 def cpu_count():
-    count = []
-    for i in range(1, len(cpu_list()) + 1):
-        count.append(i)
-    return count
+    host_mod = sys.modules['dice-virsh_utils.hostfacts']
+    return list(range(1, len(host_mod.cpus()) + 1))
 
 
 def memory():
-    mtt = eval(re.findall('MemTotal.*?:.+?(\d+)', open('/proc/meminfo', 'r').read())[0])/1024**2
+    host_mod = sys.modules['dice-virsh_utils.hostfacts']
+    mtt = host_mod.mem_total() // 1024**2
     memory_list = [x*2 for x in range(1, mtt+1)]
     return memory_list
 
@@ -781,8 +1769,7 @@ def numbertype(cmd, command, option):
     return otype
 
 
-def argtype(command, option):
-    cmd = load_commands()[command]
+def resolve_argtype(cmd, command, option):
     if (re.match('string', cmd['options'][option]['type']) and
        cmd['options'][option]['argv'] is True):
         return cmd['options'][option]['type'].replace('string', 'liststring', 1)
@@ -795,3 +1782,71 @@ def argtype(command, option):
     else:
         raise Exception('Unexpected cmd:' + command +
                         ' Unexpected option:' + option)
+
+
+def argtype_table(cmds):
+    # Resolved once per catalog build; options of unexpected types are left
+    # out and fail in argtype() as before.
+    table = {}
+    for command, cmd in cmds.items():
+        otypes = table[command] = {}
+        for option in cmd['options']:
+            try:
+                otypes[option] = resolve_argtype(cmd, command, option)
+            except Exception:
+                continue
+    return table
+
+
+def argtype(command, option):
+    if CATALOG_FORMAT == 'mmap':
+        mapped = mapped_catalog().mapping()
+        if mapped is not None:
+            otype = mapped.argtype(command, option)
+            if otype is None:
+                # Left out of the table by argtype_table(); fail the way
+                # resolve_argtype() does without decoding the JSON catalog.
+                raise Exception('Unexpected cmd:' + command +
+                                ' Unexpected option:' + option)
+            return otype
+    try:
+        return catalog().argtypes()[(command, option)]
+    except KeyError:
+        return resolve_argtype(catalog().view(command).cmd, command, option)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Export or import virsh help archives.')
+    subparsers = parser.add_subparsers(dest='action')
+    export_parser = subparsers.add_parser(
+        'export', help='dump every virsh help text of this host')
+    export_parser.add_argument('archive')
+    import_parser = subparsers.add_parser(
+        'import', help='build the command catalog from a help archive')
+    import_parser.add_argument('archive')
+    import_parser.add_argument('-o', '--output',
+                               default=os.path.join(data_dir.USER_BASE_DIR,
+                                                    'virsh'))
+    args = parser.parse_args(argv)
+
+    if args.action == 'export':
+        archive = export_help_archive(args.archive)
+        sys.stderr.write('Exported %d commands of virsh %s\n' %
+                         (len(archive['commands']), archive['version']))
+    elif args.action == 'import':
+        cmds = import_help_archive(args.archive, path=args.output)
+        sys.stderr.write('Imported %d commands into %s\n' %
+                         (len(cmds), args.output))
+    else:
+        parser.print_usage()
+        return 1
+    return 0
+
+
+if 'dice-virsh_utils.instrument' in sys.modules:
+    sys.modules['dice-virsh_utils.instrument'].install(sys.modules[__name__])
+
+
+if __name__ == '__main__':
+    sys.exit(main())